@@ -33,12 +33,29 @@ for the documentation.
 """
 from __future__ import print_function
 
+import os
 import re
+import ast
 import sys
+import atexit
+import marshal
+import hashlib
+import linecache
+import tempfile
+import textwrap
+import types
+import weakref
 import inspect
 import operator
+import functools
+import threading
 import itertools
 import collections
+from timeit import default_timer as _timer
+try:
+    from threading import get_ident as _get_ident
+except ImportError:  # Python 2
+    from thread import get_ident as _get_ident
 
 __version__ = '4.0.9'
 
@@ -71,13 +88,173 @@ else:
 ArgSpec = collections.namedtuple(
     'ArgSpec', 'args varargs varkw defaults')
 
+CacheInfo = collections.namedtuple('CacheInfo', 'hits misses currsize')
+
 
 def getargspec(f):
     """A replacement for inspect.getargspec"""
-    spec = getfullargspec(f)
+    spec = getfullargspec(_materialized(f))
     return ArgSpec(spec.args, spec.varargs, spec.varkw, spec.defaults)
 
-DEF = re.compile('\s*def\s*([_\w][_\w\d]*)\s*\(')
+DEF = re.compile(r'\s*(?:async\s+)?def\s*([_\w][_\w\d]*)\s*\(')
+
+# Python >= 3.5 and >= 3.6
+_iscoroutinefunction = getattr(inspect, 'iscoroutinefunction',
+                               lambda func: False)
+_isasyncgenfunction = getattr(inspect, 'isasyncgenfunction',
+                              lambda func: False)
+_YIELD_FROM = sys.version_info >= (3, 3)
+
+# code.replace is needed to reuse a compiled code object (Python >= 3.8)
+_CODE_REPLACE = hasattr(getargspec.__code__, 'replace')
+_CO_QUALNAME = hasattr(getargspec.__code__, 'co_qualname')  # Python >= 3.11
+_IMMUTABLE = (type(None), bool, int, float, complex, str, bytes)
+
+try:  # used to invalidate the persistent cache of the code objects
+    from importlib.util import MAGIC_NUMBER as _MAGIC
+except ImportError:  # Python 2
+    _MAGIC = b''
+
+
+def _reusable(code, func):
+    """
+    True if the function generated by executing code can be rebuilt from
+    its code object alone, i.e. if the definition did not look up any name
+    (in defaults, annotations or decorators) and the defaults are immutable
+    """
+    return (code.co_names == (func.__name__,) and func.__closure__ is None
+            and all(type(val) in _IMMUTABLE for val in
+                    (func.__defaults__ or ()) +
+                    tuple((func.__kwdefaults__ or {}).values())))
+
+
+class _CodeStore(object):
+    """
+    A persistent cache of code objects (with their defaults) in a directory.
+    Each process reads all the files in the directory when the cache is
+    first needed and writes the code objects it compiled in a new file at
+    exit; since files are written under a temporary name and then renamed,
+    concurrent processes never see a partially written file. Files written
+    by other interpreters are ignored. When merging the files, only the
+    most recent max_entries code objects are kept.
+    """
+    max_files = 16  # merge the files when there are more than these
+    max_entries = 4096  # drop the oldest code objects beyond these
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+        self.suffix = '.%s.bin' % sys.implementation.cache_tag
+        self.entries = None
+        self.new = {}
+
+    def get(self, key):
+        if self.entries is None:
+            with FunctionMaker._lock:
+                if self.entries is None:
+                    entries = {}
+                    self.load(entries)
+                    self.entries = entries
+        return self.entries.get(self.digest(key))
+
+    def put(self, key, cached):
+        digest = self.digest(key)
+        with FunctionMaker._lock:
+            if not self.new:
+                atexit.register(self.save)
+            self.entries[digest] = self.new[digest] = cached
+
+    def digest(self, key):
+        return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+    def load(self, entries):
+        try:
+            names = [name for name in os.listdir(self.dirname)
+                     if name.endswith(self.suffix)]
+        except OSError:
+            return
+        names.sort(key=self.mtime)  # from the oldest to the newest
+        loaded = []
+        for name in names:
+            try:
+                with open(os.path.join(self.dirname, name), 'rb') as f:
+                    data = f.read()
+                if not data.startswith(_MAGIC):
+                    continue
+                data = marshal.loads(data[len(_MAGIC):])
+            except (OSError, ValueError, EOFError, TypeError):
+                continue  # removed by another process or corrupted
+            if isinstance(data, dict):
+                for digest in data:  # move the entries found again last
+                    entries.pop(digest, None)
+                entries.update(data)
+                loaded.append(name)
+        excess = len(entries) - self.max_entries
+        for digest in list(entries)[:max(excess, 0)]:
+            del entries[digest]
+        if ((len(loaded) > self.max_files or excess > 0) and
+                self.write(entries)):
+            for name in loaded:
+                try:
+                    os.remove(os.path.join(self.dirname, name))
+                except OSError:  # already removed by another process
+                    pass
+
+    def mtime(self, name):
+        try:
+            return os.path.getmtime(os.path.join(self.dirname, name))
+        except OSError:  # removed by another process
+            return 0
+
+    def save(self):
+        with FunctionMaker._lock:
+            new, self.new = self.new, {}
+        if not self.write(new):
+            with FunctionMaker._lock:
+                new.update(self.new)
+                self.new = new
+
+    def write(self, entries):
+        "Write the entries in a new file; return True if it succeeds"
+        try:
+            os.makedirs(self.dirname, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.dirname, suffix='.tmp')
+        except OSError:  # the cache is best effort
+            return False
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_MAGIC + marshal.dumps(entries))
+            os.replace(tmp, tmp[:-4] + self.suffix)
+        except OSError:
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            return False
+        return True
+
+
+def _register_source(filename, src):
+    """
+    Register the source of a generated function in linecache. Lazy entries
+    are used when possible, so that the lines are split only if needed;
+    they do not work for filenames like <...>, nor in Python 2
+    """
+    if filename.startswith('<') or not hasattr(linecache, 'lazycache'):
+        linecache.cache[filename] = (
+            len(src), None, src.splitlines(True), filename)
+    else:
+        linecache.cache[filename] = (lambda: src,)
+
+
+def _callermodule():
+    "Return the name of the first module in the stack which is not this one"
+    try:
+        frame = sys._getframe(1)
+    except AttributeError:  # for IronPython and similar implementations
+        return '?'
+    while frame is not None and frame.f_globals is globals():
+        frame = frame.f_back
+    return '?' if frame is None else frame.f_globals.get('__name__', '?')
 
 
 # basic functionality
@@ -85,14 +262,63 @@ class FunctionMaker(object):
     """
     An object with the ability to create functions with a given signature.
     It has attributes name, doc, module, signature, defaults, dict and
-    methods update and make.
+    methods update and make. It is also a read-only mapping of its
+    attributes, used to expand the templates: the names arg0, arg1, ...
+    are the names of the positional arguments.
     """
+    # makers can be kept around in large numbers, so they have no __dict__
+    # (but the instances of the subclasses have one, unless they define
+    # __slots__ too)
+    __slots__ = ('name', 'doc', 'module', 'qualname', 'annotations', 'args',
+                 'varargs', 'varkw', 'defaults', 'kwonlyargs',
+                 'kwonlydefaults', 'signature', 'shortsignature', 'dict',
+                 '_sigtime')
 
-    # Atomic get-and-increment provided by the GIL
+    # The caches and counters below are read without locking, since
+    # reading a dict is atomic even without the GIL (free-threaded Python),
+    # but they are modified only while holding _lock
+    _lock = threading.RLock()
     _compile_count = itertools.count()
 
+    # If true, the filenames of the generated functions are derived from
+    # their module and qualified name, so that they are the same in every
+    # process; _filenames counts the functions with the same name
+    stable_filenames = False
+    _filenames = {}
+
+    # If true, the generated sources are registered in linecache, so that
+    # tracebacks and profilers can show them
+    register_source = False
+
+    # Code objects of the generated functions, keyed by their source with
+    # the function name stripped; the oldest entry is dropped when the
+    # cache exceeds code_cache_size entries
+    _code_cache = {}
+    code_cache_size = 1024 if _CODE_REPLACE else 0
+
+    # Directory of the persistent cache of code objects, if any
+    cache_dir = os.environ.get('DECORATOR_CACHE_DIR')
+    _stores = {}  # directory -> _CodeStore
+
+    # If true, the time spent in each phase of the generation of the
+    # functions is recorded for each caller (see .stats)
+    collect_stats = False
+    _stats = {}
+
+    # Number of functions compiled together by make_many
+    many_chunk_size = 50
+
+    # Factories of closures, one for each signature (see make_closure)
+    _factories = {}
+
+    # Signature data for each code object (see _getsignature), with the
+    # number of hits and misses
+    _signatures = weakref.WeakKeyDictionary()
+    _signature_stats = [0, 0]
+
     def __init__(self, func=None, name=None, signature=None,
                  defaults=None, doc=None, module=None, funcdict=None):
+        t0 = self.collect_stats and _timer()
         self.shortsignature = signature
         if func:
             # func can be a class or a callable, but not an instance method
@@ -101,35 +327,15 @@ class FunctionMaker(object):
                 self.name = '_lambda_'
             self.doc = func.__doc__
             self.module = func.__module__
+            self.qualname = getattr(func, '__qualname__', self.name)
             if inspect.isfunction(func):
-                argspec = getfullargspec(func)
+                _materialized(func)  # the signature of a lazy placeholder
                 self.annotations = getattr(func, '__annotations__', {})
-                for a in ('args', 'varargs', 'varkw', 'defaults', 'kwonlyargs',
-                          'kwonlydefaults'):
-                    setattr(self, a, getattr(argspec, a))
-                for i, arg in enumerate(self.args):
-                    setattr(self, 'arg%d' % i, arg)
-                if sys.version < '3':  # easy way
-                    self.shortsignature = self.signature = (
-                        inspect.formatargspec(
-                            formatvalue=lambda val: "", *argspec)[1:-1])
-                else:  # Python 3 way
-                    allargs = list(self.args)
-                    allshortargs = list(self.args)
-                    if self.varargs:
-                        allargs.append('*' + self.varargs)
-                        allshortargs.append('*' + self.varargs)
-                    elif self.kwonlyargs:
-                        allargs.append('*')  # single star syntax
-                    for a in self.kwonlyargs:
-                        allargs.append('%s=None' % a)
-                        allshortargs.append('%s=%s' % (a, a))
-                    if self.varkw:
-                        allargs.append('**' + self.varkw)
-                        allshortargs.append('**' + self.varkw)
-                    self.signature = ', '.join(allargs)
-                    self.shortsignature = ', '.join(allshortargs)
-                self.dict = func.__dict__.copy()
+                (self.args, self.varargs, self.varkw, self.defaults,
+                 self.kwonlyargs, self.kwonlydefaults, self.signature,
+                 self.shortsignature) = self._getsignature(func)
+                if func.__dict__:
+                    self.dict = func.__dict__.copy()
         # func=None happens when decorating a caller
         if name:
             self.name = name
@@ -147,58 +353,319 @@ class FunctionMaker(object):
         assert hasattr(self, 'name')
         if not hasattr(self, 'signature'):
             raise TypeError('You are decorating a non function: %s' % func)
+        if t0:  # recorded when the caller is known
+            self._sigtime = _timer() - t0
+
+    @classmethod
+    def _getsignature(cls, func):
+        """
+        Return args, varargs, varkw, defaults, kwonlyargs, kwonlydefaults,
+        signature and shortsignature of func. Everything but the defaults
+        depends only on the code object, so it is cached for each code
+        object, unless func has a __signature__.
+        """
+        cacheable = '__signature__' not in func.__dict__
+        sig = cls._signatures.get(func.__code__) if cacheable else None
+        if sig is not None:
+            with cls._lock:
+                cls._signature_stats[0] += 1
+            args, varargs, varkw, kwonlyargs, signature, shortsignature = sig
+            kwonlydefaults = getattr(func, '__kwdefaults__', None)
+            return (list(args), varargs, varkw, func.__defaults__,
+                    list(kwonlyargs), kwonlydefaults and dict(kwonlydefaults),
+                    signature, shortsignature)
+        with cls._lock:
+            cls._signature_stats[1] += 1
+        argspec = getfullargspec(func)
+        args, varargs, varkw, kwonlyargs = (
+            argspec.args, argspec.varargs, argspec.varkw, argspec.kwonlyargs)
+        if sys.version < '3':  # easy way
+            shortsignature = signature = (
+                inspect.formatargspec(
+                    formatvalue=lambda val: "", *argspec)[1:-1])
+        else:  # Python 3 way
+            allargs = list(args)
+            allshortargs = list(args)
+            if varargs:
+                allargs.append('*' + varargs)
+                allshortargs.append('*' + varargs)
+            elif kwonlyargs:
+                allargs.append('*')  # single star syntax
+            for a in kwonlyargs:
+                allargs.append('%s=None' % a)
+                allshortargs.append('%s=%s' % (a, a))
+            if varkw:
+                allargs.append('**' + varkw)
+                allshortargs.append('**' + varkw)
+            signature = ', '.join(allargs)
+            shortsignature = ', '.join(allshortargs)
+        if cacheable:
+            with cls._lock:
+                cls._signatures[func.__code__] = (
+                    tuple(args), varargs, varkw, tuple(kwonlyargs),
+                    signature, shortsignature)
+        return (args, varargs, varkw, argspec.defaults, kwonlyargs,
+                argspec.kwonlydefaults, signature, shortsignature)
+
+    def __getitem__(self, name):
+        "Return the attribute used in the templates as %(name)s"
+        try:
+            if name.startswith('arg') and name[3:].isdigit():
+                return self.args[int(name[3:])]
+            return getattr(self, name)
+        except (AttributeError, IndexError):
+            raise KeyError(name)
+
+    @classmethod
+    def signature_cache_info(cls):
+        "Return the hits, misses and size of the cache of the signatures"
+        hits, misses = cls._signature_stats
+        return CacheInfo(hits, misses, len(cls._signatures))
 
     def update(self, func, **kw):
         "Update the signature of func with the data in self"
         func.__name__ = self.name
         func.__doc__ = getattr(self, 'doc', None)
-        func.__dict__ = getattr(self, 'dict', {})
+        funcdict = getattr(self, 'dict', None)
+        if funcdict:  # the __dict__ of a new function is created on demand
+            func.__dict__ = funcdict
         func.__defaults__ = getattr(self, 'defaults', ())
         func.__kwdefaults__ = getattr(self, 'kwonlydefaults', None)
         func.__annotations__ = getattr(self, 'annotations', None)
         try:
-            frame = sys._getframe(3)
-        except AttributeError:  # for IronPython and similar implementations
-            callermodule = '?'
-        else:
-            callermodule = frame.f_globals.get('__name__', '?')
-        func.__module__ = getattr(self, 'module', callermodule)
-        func.__dict__.update(kw)
+            func.__module__ = self.module
+        except AttributeError:  # look at the frames only if needed
+            func.__module__ = _callermodule()
+        if kw:
+            func.__dict__.update(kw)
 
     def make(self, src_templ, evaldict=None, addsource=False, **attrs):
         "Make a new function from a given template and update the signature"
-        src = src_templ % vars(self)  # expand name and signature
+        t0 = self.collect_stats and _timer()
+        src = src_templ % self  # expand name and signature
         evaldict = evaldict or {}
         mo = DEF.match(src)
         if mo is None:
             raise SyntaxError('not a valid function template\n%s' % src)
         name = mo.group(1)  # extract the function name
-        names = set([name] + [arg.strip(' *') for arg in
-                              self.shortsignature.split(',')])
-        for n in names:
-            if n in ('_func_', '_call_'):
-                raise NameError('%s is overridden in\n%s' % (n, src))
+        self._check_names(name, src, src_templ)
 
         if not src.endswith('\n'):  # add a newline for old Pythons
             src += '\n'
 
-        # Ensure each generated function has a unique filename for profilers
-        # (such as cProfile) that depend on the tuple of (<filename>,
-        # <definition line>, <function name>) being unique.
-        filename = '<decorator-gen-%d>' % (next(self._compile_count),)
-        try:
-            code = compile(src, filename, 'single')
-            exec(code, evaldict)
-        except:
-            print('Error in generated code:', file=sys.stderr)
-            print(src, file=sys.stderr)
-            raise
-        func = evaldict[name]
+        if t0:
+            caller = evaldict.get('_call_')
+            self._record(caller, 'signature', 0,
+                         getattr(self, '_sigtime', 0.))
+            self._record(caller, 'expand', t0)
+        func = self._compile(src, mo, self._newfile(src), evaldict)
         if addsource:
             attrs['__source__'] = src
+        t0 = self.collect_stats and _timer()
         self.update(func, **attrs)
+        if t0:
+            self._record(evaldict.get('_call_'), 'update', t0)
+        return func
+
+    def make_closure(self, caller, func, rename=False, **attrs):
+        """
+        Make a function calling caller(func, <arguments>) by means of a
+        factory of closures, generated only once for each signature, then
+        update the signature. If rename is true the function gets its own
+        code object, with its name and a new filename, but it still shares
+        the globals of the factory.
+        """
+        kind = _wrapper_kind(func, caller)
+        key = self.signature, self.shortsignature, kind
+        factory = self._factories.get(key)
+        if factory is None:
+            src = self._closure_source(kind)
+            self._check_names('_wrapper_', src, _call_template(kind))
+            filename = self._newfile(src, '(%s)' % self.signature)
+            factory = self._compile(src, DEF.match(src), filename, {}, caller)
+            with self._lock:
+                factory = self._factories.setdefault(key, factory)
+        t0 = self.collect_stats and _timer()
+        fun = factory(caller, func)
+        if rename and _CODE_REPLACE:
+            code = fun.__code__
+            # the source is needed only to register it in linecache
+            filename = self._newfile(self._closure_source(kind)
+                                     if self.register_source else '')
+            if _CO_QUALNAME:
+                fun.__code__ = code.replace(
+                    co_filename=filename, co_name=self.name,
+                    co_qualname=getattr(self, 'qualname', self.name))
+            else:
+                fun.__code__ = code.replace(co_filename=filename,
+                                            co_name=self.name)
+        if t0:
+            self._record(caller, 'signature', 0,
+                         getattr(self, '_sigtime', 0.))
+            self._record(caller, 'exec', t0)
+            t0 = _timer()
+        self.update(fun, **attrs)
+        if t0:
+            self._record(caller, 'update', t0)
+        return fun
+
+    def _closure_source(self, kind):
+        "Return the source of the factory of closures used by make_closure"
+        wrapper = _call_template(kind) % dict(
+            name='_wrapper_', signature=self.signature,
+            shortsignature=self.shortsignature)
+        return ('def _make_wrapper_(_call_, _func_):\n' +
+                ''.join('    ' + line + '\n' for line in wrapper.split('\n'))
+                + '    return _wrapper_\n')
+
+    def _newfile(self, src, label=None):
+        """
+        Return a new filename for the generated source src and register the
+        source in linecache if register_source is set.
+        Ensure each generated function has a unique filename for profilers
+        (such as cProfile) that depend on the tuple of (<filename>,
+        <definition line>, <function name>) being unique. With
+        stable_filenames the filename depends on the label (by default
+        module and qualified name) and not on the order of generation.
+        """
+        if self.stable_filenames:
+            if label is None:
+                label = '%s.%s' % (getattr(self, 'module', '?'),
+                                   getattr(self, 'qualname', self.name))
+            with self._lock:
+                n = self._filenames.get(label, 0)
+                self._filenames[label] = n + 1
+            filename = 'decorator-gen:' + label + ('#%d' % n if n else '')
+        else:
+            with self._lock:
+                n = next(self._compile_count)
+            filename = '<decorator-gen-%d>' % n
+        if self.register_source:
+            _register_source(filename, src)
+        return filename
+
+    # names used by some templates, not allowed as arguments of the
+    # functions generated from them; _func_ and _call_ are always reserved
+    _reserved = ('_state_', '_item_', '_exc_', '_memo_', '_key_', '_value_',
+                 '_flight_', '_funcs_')
+
+    def _check_names(self, name, src, templ=''):
+        "Make sure that the reserved names are not used by the signature"
+        names = set([name] + [arg.split('=')[0].strip(' *') for arg in
+                              self.shortsignature.split(',')])
+        reserved = ['_func_', '_call_'] + [
+            n for n in self._reserved if n in templ]
+        for n in names:
+            if n in reserved:
+                raise NameError('%s is overridden in\n%s' % (n, src))
+
+    def _compile(self, src, mo, filename, evaldict, caller=None):
+        """
+        Compile and execute the source of a function definition in evaldict,
+        reusing the code object of a previous function differing only in
+        the name, if any; return the new function. The caller, by default
+        evaldict['_call_'], is used only for the statistics.
+        """
+        name = mo.group(1)
+        if caller is None:
+            caller = evaldict.get('_call_')
+        key = src[:mo.start(1)] + src[mo.end(1):]
+        cached = self._code_cache.get(key)
+        if cached is None and self.cache_dir and _CODE_REPLACE:
+            store = self._stores.get(self.cache_dir)
+            if store is None:
+                with self._lock:
+                    store = self._stores.setdefault(
+                        self.cache_dir, _CodeStore(self.cache_dir))
+            cached = store.get(key)
+            if cached is not None:
+                self._cache_code(key, cached)
+        if cached is None:
+            t0 = self.collect_stats and _timer()
+            try:
+                code = compile(src, filename, 'single')
+                if t0:
+                    self._record(caller, 'compile', t0)
+                    t0 = _timer()
+                exec(code, evaldict)
+            except:
+                print('Error in generated code:', file=sys.stderr)
+                print(src, file=sys.stderr)
+                raise
+            if t0:
+                self._record(caller, 'exec', t0)
+            func = evaldict[name]
+            if _CODE_REPLACE and _reusable(code, func):
+                cached = func.__code__, func.__defaults__, func.__kwdefaults__
+                self._cache_code(key, cached)
+                if self.cache_dir:
+                    self._stores[self.cache_dir].put(key, cached)
+            return func
+        t0 = self.collect_stats and _timer()
+        code, defaults, kwdefaults = cached
+        if _CO_QUALNAME:
+            code = code.replace(co_filename=filename, co_name=name,
+                                co_qualname=name)
+        else:
+            code = code.replace(co_filename=filename, co_name=name)
+        # exec adds the builtins, FunctionType does not (Python < 3.10)
+        evaldict.setdefault('__builtins__', __builtins__)
+        func = types.FunctionType(code, evaldict, name, defaults)
+        if kwdefaults is not None:
+            func.__kwdefaults__ = dict(kwdefaults)
+        evaldict[name] = func
+        if t0:
+            self._record(caller, 'exec', t0)
         return func
 
+    @classmethod
+    def _record(cls, caller, phase, t0, elapsed=None):
+        """
+        Add the time elapsed since t0 (or the given elapsed time) to the
+        statistics of the phase for the given caller
+        """
+        if elapsed is None:
+            elapsed = _timer() - t0
+        if isinstance(caller, functools.partial):  # see decorator_factory
+            caller = caller.func
+        if caller is None:
+            key = '?'
+        else:
+            key = '%s.%s' % (getattr(caller, '__module__', '?'), getattr(
+                caller, '__qualname__', getattr(
+                    caller, '__name__', type(caller).__name__)))
+        with cls._lock:
+            counts = cls._stats.setdefault(key, {}).setdefault(
+                phase, [0, 0.])
+            counts[0] += 1
+            counts[1] += elapsed
+
+    @classmethod
+    def stats(cls):
+        """
+        Return a dictionary caller -> phase -> (count, seconds) with the
+        time spent generating functions, if collect_stats is set. The phases
+        are signature, expand, compile, exec and update.
+        """
+        with cls._lock:
+            return dict((caller, dict((phase, tuple(counts))
+                                      for phase, counts in phases.items()))
+                        for caller, phases in cls._stats.items())
+
+    @classmethod
+    def reset_stats(cls):
+        "Reset the statistics returned by .stats()"
+        with cls._lock:
+            cls._stats.clear()
+
+    def _cache_code(self, key, cached):
+        "Store a code object with its defaults in the cache in memory"
+        if self.code_cache_size:
+            with self._lock:  # dicts keep the insertion order
+                if len(self._code_cache) >= self.code_cache_size:
+                    del self._code_cache[next(iter(self._code_cache))]
+                self._code_cache[key] = cached
+
     @classmethod
     def create(cls, obj, body, evaldict, defaults=None,
                doc=None, module=None, addsource=True, **attrs):
@@ -208,6 +675,93 @@ class FunctionMaker(object):
         attribute __source__ is added to the result. The attributes attrs
         are added, if any.
         """
+        self = cls._fromobj(obj, defaults, doc, module)
+        return self.make(_template(body), evaldict, addsource, **attrs)
+
+    @classmethod
+    def create_many(cls, specs, evaldict, addsource=True):
+        """
+        Create many functions by compiling a single source. specs is a
+        sequence of pairs (obj, body) or triples (obj, body, kw), where
+        obj and body are as in .create and kw is a dictionary with the other
+        arguments of .create. Return the list of the functions.
+        """
+        makers, templates, attrs = [], [], []
+        for spec in specs:
+            obj, body = spec[:2]
+            kw = dict(spec[2]) if len(spec) > 2 else {}
+            makers.append(cls._fromobj(
+                obj, kw.pop('defaults', None), kw.pop('doc', None),
+                kw.pop('module', None)))
+            templates.append(_template(body))
+            attrs.append(kw)
+        return cls.make_many(makers, templates, evaldict, addsource, attrs)
+
+    @classmethod
+    def make_many(cls, makers, templates, evaldict, addsource=False,
+                  attrs=None):
+        """
+        Make a function for each maker from the corresponding template,
+        by compiling all of them as a single source, then update the
+        signatures; attrs is an optional list of dictionaries of attributes
+        """
+        caller = evaldict.get('_call_')
+        t0 = cls.collect_stats and _timer()
+        srcs, names = [], []
+        for self, src_templ in zip(makers, templates):
+            if t0:
+                self._record(caller, 'signature', 0,
+                             getattr(self, '_sigtime', 0.))
+            src = src_templ % self
+            mo = DEF.match(src)
+            if mo is None:
+                raise SyntaxError('not a valid function template\n%s' % src)
+            self._check_names(mo.group(1), src, src_templ)
+            if not src.endswith('\n'):
+                src += '\n'
+            srcs.append(src)
+            names.append(mo.group(1))
+        if t0:
+            cls._record(caller, 'expand', t0)
+        # the functions are collected in a list, since they can have the
+        # same name; the functions compiled together have the same filename
+        # but different line numbers; compiling very large sources is slower
+        # so the functions are compiled in chunks of many_chunk_size
+        evaldict['_made_'] = funcs = []
+        try:
+            for i in range(0, len(srcs), cls.many_chunk_size):
+                src = ''.join('%s_made_.append(%s)\n' % pair for pair in zip(
+                    srcs[i:i + cls.many_chunk_size],
+                    names[i:i + cls.many_chunk_size]))
+                filename = makers[i]._newfile(src)
+                t0 = cls.collect_stats and _timer()
+                try:
+                    code = compile(src, filename, 'exec')
+                    if t0:
+                        cls._record(caller, 'compile', t0)
+                        t0 = _timer()
+                    exec(code, evaldict)
+                    if t0:
+                        cls._record(caller, 'exec', t0)
+                except:
+                    print('Error in generated code:', file=sys.stderr)
+                    print(src, file=sys.stderr)
+                    raise
+        finally:
+            del evaldict['_made_']
+        t0 = cls.collect_stats and _timer()
+        for i, (self, func) in enumerate(zip(makers, funcs)):
+            kw = dict(attrs[i]) if attrs else {}
+            if addsource:
+                kw['__source__'] = srcs[i]
+            self.update(func, **kw)
+        if t0:
+            cls._record(caller, 'update', t0)
+        return funcs
+
+    @classmethod
+    def _fromobj(cls, obj, defaults, doc, module):
+        "Make a FunctionMaker from a string name(signature) or a function"
         if isinstance(obj, str):  # "name(signature)"
             name, rest = obj.strip().split('(', 1)
             signature = rest[:-1]  # strip a right parens
@@ -216,31 +770,457 @@ class FunctionMaker(object):
             name = None
             signature = None
             func = obj
-        self = cls(func, name, signature, defaults, doc, module)
-        ibody = '\n'.join('    ' + line for line in body.splitlines())
-        return self.make('def %(name)s(%(signature)s):\n' + ibody,
-                         evaldict, addsource, **attrs)
+        return cls(func, name, signature, defaults, doc, module)
+
+
+class ItemCaller(object):
+    """
+    Base class of the callers of generator functions (or asynchronous
+    generator functions) observing the items one at the time, as they are
+    produced: the decorated generator calls .start(func, *args, **kw) when
+    the iteration begins, .item(state, item) for each item and
+    .stop(state, exc) when the iteration ends, where state is the value
+    returned by .start and exc the exception raised by the generator (or
+    None); .item returns the item to be yielded. Nothing is buffered.
+    """
+    def start(self, func, *args, **kw):
+        "Called before the first item; the result is passed to the hooks"
+
+    def item(self, state, item):
+        "Called for each item; return the item to be yielded"
+        return item
+
+    def stop(self, state, exc):
+        "Called after the last item, or when the generator raises exc"
+
+    def __call__(self, func, *args, **kw):
+        # the same protocol, for the code calling the caller directly
+        state = self.start(func, *args, **kw)
+        try:
+            for item in func(*args, **kw):
+                yield self.item(state, item)
+        except BaseException as exc:
+            self.stop(state, exc)
+            raise
+        self.stop(state, None)
+
+
+def _template(body, isasync=False):
+    "Return the template of a function (or coroutine) with the given body"
+    ibody = '\n'.join('    ' + line for line in body.splitlines())
+    return ('async def' if isasync else 'def') + \
+        ' %(name)s(%(signature)s):\n' + ibody
+
+
+def _wrapper_kind(func, caller):
+    """
+    Return the kind of function needed to decorate func with caller: ''
+    for a plain function, 'coroutine', 'generator' or 'async generator'
+    for a wrapper of the same kind of func, 'items' or 'async items' for
+    a generator calling the hooks of an ItemCaller. A (generator or
+    coroutine) function gets a wrapper of its kind only if the caller is
+    of the same kind, since a plain caller may return anything (for
+    instance a list, or the result of asyncio.run).
+    """
+    if isinstance(caller, ItemCaller):
+        if _isasyncgenfunction(func):
+            return 'async items'
+        elif inspect.isgeneratorfunction(func):
+            return 'items'
+        raise TypeError('%s is not a generator function' % func)
+    elif _iscoroutinefunction(func) and _iscoroutinefunction(caller):
+        return 'coroutine'
+    elif _isasyncgenfunction(func) and _isasyncgenfunction(caller):
+        return 'async generator'
+    elif _YIELD_FROM and inspect.isgeneratorfunction(func) and (
+            inspect.isgeneratorfunction(caller)):
+        return 'generator'
+    return ''
+
+
+_ITEMS = '''\
+_state_ = _call_.start(%(func)s, %%(shortsignature)s)
+try:
+    %(for)s _item_ in %(func)s(%%(shortsignature)s):
+        yield _call_.item(_state_, _item_)
+except BaseException as _exc_:
+    _call_.stop(_state_, _exc_)
+    raise
+_call_.stop(_state_, None)'''
+
+
+def _call_template(kind, name='_func_'):
+    """
+    Return the template of a decorated function of the given kind (see
+    _wrapper_kind) calling _call_ with the function name and the arguments
+    """
+    call = '_call_(%s, %%(shortsignature)s)' % name
+    if kind == 'coroutine':
+        return _template('return await ' + call, True)
+    elif kind == 'generator':
+        return _template('return (yield from %s)' % call)
+    elif kind == 'async generator':
+        return _template('async for _item_ in %s:\n    yield _item_' % call,
+                         True)
+    elif kind == 'items':
+        return _template(_ITEMS % {'func': name, 'for': 'for'})
+    elif kind == 'async items':
+        return _template(_ITEMS % {'func': name, 'for': 'async for'}, True)
+    return _template('return ' + call)
 
 
-def decorate(func, caller):
+def decorate(func, caller, mode='exec'):
     """
     decorate(func, caller) decorates a function using a caller.
+    With mode='closure' the decorated function is a closure built by a
+    factory shared by all functions with the same signature, without
+    compiling anything after the first time. With mode='shared' the
+    decorated functions share the factory too, but each one gets its own
+    code object and filename, as with the default mode='exec', without
+    having its own globals. With mode='lazy' the
+    decorated function is generated only when it is called the first time.
+    With mode='inline' the body of a simple caller is copied into the
+    decorated function, if possible; the attribute __inlined__ tells if
+    that happened. With mode='fuse', if func is itself a decorated function,
+    the callers are chained without calling the intermediate function.
+    With mode='light' nothing is generated: the result is a predefined
+    closure passing the arguments to the caller without checking them.
+    With mode='method', if func is a class, its methods, classmethods,
+    staticmethods and properties are decorated in place, as functions
+    (so that CPython calls them without creating bound methods).
+    If func and caller are both coroutine functions, generator functions
+    or asynchronous generator functions, so is the decorated function,
+    which awaits or iterates over the result of the caller, and the modes
+    lazy, inline and light fall back to exec; the same happens if caller
+    is an ItemCaller.
     """
-    evaldict = dict(_call_=caller, _func_=func)
-    fun = FunctionMaker.create(
-        func, "return _call_(_func_, %(shortsignature)s)",
-        evaldict, __wrapped__=func)
+    if mode == 'method':
+        if inspect.isclass(func):
+            return _decorate_class(func, caller)
+        mode = 'exec'
+    kind = _wrapper_kind(func, caller)
+    if kind and mode in ('lazy', 'inline', 'light'):
+        mode = 'exec'
+    if mode == 'exec':
+        evaldict = dict(_call_=caller, _func_=func)
+        _mark_link(evaldict, kind)
+        fun = FunctionMaker(func).make(
+            _call_template(kind), evaldict, True, __wrapped__=func)
+    elif mode == 'closure':
+        fun = FunctionMaker(func).make_closure(caller, func, __wrapped__=func)
+    elif mode == 'shared':
+        fun = FunctionMaker(func).make_closure(caller, func, True,
+                                               __wrapped__=func)
+    elif mode == 'lazy':
+        fun = _decorate_lazy(func, caller)
+    elif mode == 'inline':
+        fun = _decorate_inline(func, caller)
+    elif mode == 'light':
+        fun = _decorate_light(func, caller)
+    elif mode == 'fuse':
+        evaldict = dict(_call_=caller, _func_=_fuse(func))
+        _mark_link(evaldict, kind)
+        fun = FunctionMaker(func).make(
+            _call_template(kind), evaldict, True, __wrapped__=func)
+    else:
+        raise ValueError('Unknown decoration mode %r' % mode)
     if hasattr(func, '__qualname__'):
         fun.__qualname__ = func.__qualname__
     return fun
 
 
-def decorator(caller, _func=None):
+# ############################ fusion ################################ #
+
+class _Link(functools.partial):
+    """
+    A link in a chain of fused callers: calling it calls the inner caller
+    with the inner function, without creating Python frames; the other
+    attributes are the ones of the decorated function it replaces.
+    """
+    def __getattr__(self, name):
+        return getattr(self.__dict__['_target_'], name)
+
+
+def _mark_link(evaldict, kind):
+    """
+    Mark the globals of a function generated by decorate as a link that
+    _fuse can shortcut; the item callers are not, since calling them
+    directly does not work for asynchronous generators
+    """
+    if kind not in ('items', 'async items'):
+        evaldict['_link_'] = evaldict['_call_'], evaldict['_func_']
+
+
+def _fuse(func):
+    """
+    If func was generated by decorate(inner, caller), return a _Link
+    calling caller(inner, ...) directly, otherwise return func
+    """
+    link = getattr(func, '__globals__', {}).get('_link_')
+    if link is None or getattr(link[1], '_target_', link[1]) is not getattr(
+            func, '__wrapped__', None):
+        return func
+    link = _Link(*link)
+    link._target_ = func
+    link.__doc__ = func.__doc__
+    link.__module__ = func.__module__
+    return link
+
+
+def _decorate_light(func, caller):
+    """
+    Return a predefined closure calling caller with func and the arguments,
+    as they are: nothing is compiled and, being a function, it binds as a
+    method natively
+    """
+    def light(*args, **kw):
+        return caller(func, *args, **kw)
+    light.__dict__.update(func.__dict__)
+    light.__name__ = func.__name__
+    light.__doc__ = func.__doc__
+    light.__module__ = func.__module__
+    light.__wrapped__ = func  # inspect.signature follows it
+    return light
+
+
+# ########################### inlining ############################## #
+
+_INLINE_STMTS = tuple(getattr(ast, n) for n in (
+    'Expr', 'Assign', 'AugAssign', 'AnnAssign', 'Return', 'Pass')
+    if hasattr(ast, n))
+_NOT_INLINE_NODES = tuple(getattr(ast, n) for n in (
+    'Lambda', 'ListComp', 'SetComp', 'DictComp', 'GeneratorExp', 'Yield',
+    'YieldFrom', 'Await', 'Global', 'Nonlocal') if hasattr(ast, n))
+_GENERATOR_FLAGS = (inspect.CO_GENERATOR |
+                    getattr(inspect, 'CO_COROUTINE', 0) |
+                    getattr(inspect, 'CO_ASYNC_GENERATOR', 0))
+_inline_bodies = weakref.WeakKeyDictionary()  # caller -> (body, names)
+
+
+def _inline_body(caller):
+    """
+    Return the body of caller (as source code with a placeholder
+    _inlined_call_ for the call to the decorated function) and the set of
+    names it uses, or None if caller cannot be inlined. Inlinable callers
+    are plain functions with signature (func, *args, **kw) containing
+    only straight-line code and a single call func(*args, **kw).
+    """
+    if not hasattr(ast, 'unparse'):  # Python < 3.9
+        return None
+    try:
+        return _inline_bodies[caller]
+    except (KeyError, TypeError):
+        pass
+    body = None
+    spec = getfullargspec(caller) if inspect.isfunction(caller) else None
+    if (spec and len(spec.args) == 1 and spec.varargs and spec.varkw and
+            not spec.defaults and not spec.kwonlyargs and
+            caller.__closure__ is None and
+            not caller.__code__.co_flags & _GENERATOR_FLAGS):
+        try:
+            tree = ast.parse(textwrap.dedent(inspect.getsource(caller)))
+        except (OSError, IOError, TypeError, SyntaxError):
+            tree = None
+        if tree and isinstance(tree.body[0], ast.FunctionDef):
+            body = _inline_transform(tree.body[0], spec)
+    try:
+        with FunctionMaker._lock:
+            _inline_bodies[caller] = body
+    except TypeError:  # not weak-referenceable
+        pass
+    return body
+
+
+def _inline_transform(node, spec):
+    "Helper of _inline_body returning the transformed body or None"
+    func, args, kw = spec.args[0], spec.varargs, spec.varkw
+    stmts = node.body
+    if (stmts and isinstance(stmts[0], ast.Expr) and
+            isinstance(stmts[0].value, ast.Constant) and
+            isinstance(stmts[0].value.value, str)):
+        stmts = stmts[1:]  # strip the docstring
+    if node.decorator_list or not stmts or not all(
+            isinstance(stmt, _INLINE_STMTS) for stmt in stmts):
+        return None
+    calls, names = [], set()
+    for stmt in stmts:
+        for sub in ast.walk(stmt):
+            if isinstance(sub, _NOT_INLINE_NODES):
+                return None
+            if (isinstance(sub, ast.Call) and isinstance(sub.func, ast.Name)
+                    and sub.func.id == func and len(sub.args) == 1 and
+                    isinstance(sub.args[0], ast.Starred) and
+                    isinstance(sub.args[0].value, ast.Name) and
+                    sub.args[0].value.id == args and len(sub.keywords) == 1
+                    and sub.keywords[0].arg is None and
+                    isinstance(sub.keywords[0].value, ast.Name) and
+                    sub.keywords[0].value.id == kw):
+                calls.append(sub)
+            elif isinstance(sub, ast.Name):
+                names.add(sub.id)
+    if len(calls) != 1:
+        return None
+    # args and kw are allowed only in the call; func is renamed _func_
+    names -= set(n.id for n in ast.walk(calls[0]) if isinstance(n, ast.Name))
+    if args in names or kw in names:
+        return None
+    for stmt in stmts:
+        for sub in ast.walk(stmt):
+            if isinstance(sub, ast.Name) and sub.id == func:
+                sub.id = '_func_'
+    call = calls[0]
+    call.func, call.args, call.keywords = (
+        ast.Name(id='_inlined_call_', ctx=ast.Load()), [], [])
+    names.discard(func)
+    src = '\n'.join(ast.unparse(stmt) for stmt in stmts)
+    return src.replace('%', '%%').replace(
+        '_inlined_call_()', '_func_(%(shortsignature)s)'), names
+
+
+def _decorate_inline(func, caller):
+    """
+    Generate a decorated function containing the body of the caller, with
+    the call to func performed directly with the signature of func, or
+    fallback to the standard decoration if that is not possible
+    """
+    inline = _inline_body(caller)
+    maker = FunctionMaker(func)
+    params = set(maker.args + maker.kwonlyargs + [
+        maker.varargs, maker.varkw, maker.name, '_func_', '_call_'])
+    if inline is None or inline[1] & params:
+        fun = decorate(func, caller)
+        fun.__inlined__ = False
+        return fun
+    body, _ = inline
+    ibody = '\n'.join('        ' + line for line in body.splitlines())
+    src = ('def _make_inline_(_func_):\n'
+           '    def %(name)s(%(signature)s):\n' + ibody + '\n'
+           '    return %(name)s\n') % maker
+    filename = maker._newfile(src)
+    factory = maker._compile(src, DEF.match(src), filename, {}, caller)
+    # the inlined body must see the globals of the caller
+    factory = types.FunctionType(factory.__code__, caller.__globals__)
+    fun = factory(func)
+    if _CODE_REPLACE:  # the inner code may come from the cache
+        fun.__code__ = fun.__code__.replace(co_filename=filename)
+    maker.update(fun, __wrapped__=func, __inlined__=True)
+    return fun
+
+
+def _lazy_call(*args, **kw):
+    "The code of the placeholders returned by decorate(..., mode='lazy')"
+    return _materialize_()(*args, **kw)
+
+
+_lazy_lock = threading.RLock()
+
+
+def _materialized(func):
+    """
+    Return func, after generating its code if it is a placeholder returned
+    by decorate(..., mode='lazy'), whose own signature is (*args, **kw)
+    """
+    if getattr(func, '__code__', None) is _lazy_call.__code__:
+        func.__globals__['_materialize_']()
+    return func
+
+
+def _decorate_lazy(func, caller):
+    """
+    Return a placeholder with the name, docstring and attributes of func
+    and a __wrapped__ attribute, so that inspect.signature works. At the
+    first call the decorated function is generated and its code object
+    and defaults are given to the placeholder, which becomes
+    indistinguishable from the function returned by decorate.
+    """
+    if not inspect.isfunction(func):
+        raise TypeError('You are decorating a non function: %s' % func)
+    evaldict = dict(_call_=caller, _func_=func, __builtins__=__builtins__)
+    name = '_lambda_' if func.__name__ == '<lambda>' else func.__name__
+    fun = types.FunctionType(_lazy_call.__code__, evaldict, name)
+
+    def materialize():
+        with _lazy_lock:
+            if fun.__code__ is _lazy_call.__code__:
+                real = FunctionMaker.create(
+                    func, "return _call_(_func_, %(shortsignature)s)",
+                    evaldict, addsource=False)
+                fun.__defaults__ = real.__defaults__
+                if sys.version >= '3':
+                    fun.__kwdefaults__ = real.__kwdefaults__
+                fun.__code__ = real.__code__
+        return fun
+    evaldict['_materialize_'] = materialize
+    fun.__doc__ = func.__doc__
+    if func.__dict__:
+        fun.__dict__ = func.__dict__.copy()
+    fun.__module__ = func.__module__
+    fun.__annotations__ = getattr(func, '__annotations__', None)
+    fun.__wrapped__ = func
+    return fun
+
+
+# ############################# methods ############################### #
+
+def _decorate_class(cls, caller):
+    """
+    Decorate in place the methods, classmethods, staticmethods and
+    properties defined in cls, except the special methods; return cls
+    """
+    for name, attr in list(vars(cls).items()):
+        if name.startswith('__') and name.endswith('__'):
+            continue
+        elif inspect.isfunction(attr):
+            new = decorate(attr, caller)
+        elif isinstance(attr, (classmethod, staticmethod)):
+            new = type(attr)(decorate(attr.__func__, caller))
+        elif isinstance(attr, property):
+            new = type(attr)(*[func and decorate(func, caller) for func in
+                               (attr.fget, attr.fset, attr.fdel)],
+                             doc=attr.__doc__)
+        else:
+            continue
+        setattr(cls, name, new)
+    return cls
+
+
+def decorate_many(funcs, caller):
+    """
+    decorate_many(funcs, caller) decorates many functions using the same
+    caller, by compiling all the decorated functions at once; it returns
+    the list of the decorated functions.
+    """
+    funcs = list(funcs)
+    evaldict = dict(_call_=caller, _funcs_=tuple(funcs))
+    makers = [FunctionMaker(func) for func in funcs]
+    templates = [_call_template(_wrapper_kind(func, caller), '_funcs_[%d]' % i)
+                 for i, func in enumerate(funcs)]
+    funs = FunctionMaker.make_many(
+        makers, templates, evaldict, True,
+        [dict(__wrapped__=func) for func in funcs])
+    for func, fun in zip(funcs, funs):
+        if hasattr(func, '__qualname__'):
+            fun.__qualname__ = func.__qualname__
+    return funs
+
+
+# decorators made by decorator(caller, mode=mode), reused as long as they
+# are alive; they are keyed by (id(caller), mode), since the decorators
+# keep their caller alive and the ids are not reused until the entries
+# are removed
+_decorators = weakref.WeakValueDictionary()
+
+
+def decorator(caller, _func=None, mode='exec'):
     """decorator(caller) converts a caller function into a decorator"""
     if _func is not None:  # return a decorated function
         # this is obsolete behavior; you should use decorate instead
-        return decorate(_func, caller)
+        return decorate(_func, caller, mode)
     # else return a decorator function
+    key = id(caller), mode
+    dec = _decorators.get(key)
+    if dec is not None and dec.__wrapped__ is caller:
+        return dec
     if inspect.isclass(caller):
         name = caller.__name__.lower()
         doc = 'decorator(%s) converts functions/generators into ' \
@@ -254,11 +1234,45 @@ def decorator(caller, _func=None):
     else:  # assume caller is an object with a __call__ method
         name = caller.__class__.__name__.lower()
         doc = caller.__call__.__doc__
-    evaldict = dict(_call_=caller, _decorate_=decorate)
-    return FunctionMaker.create(
-        '%s(func)' % name, 'return _decorate_(func, _call_)',
+    evaldict = dict(_call_=caller, _decorate_=decorate, _mode_=mode)
+    dec = FunctionMaker.create(
+        '%s(func)' % name, 'return _decorate_(func, _call_, _mode_)',
         evaldict, doc=doc, module=caller.__module__,
         __wrapped__=caller)
+    with FunctionMaker._lock:
+        _decorators[key] = dec
+    return dec
+
+
+def decorator_factory(caller, mode='exec'):
+    """
+    decorator_factory(caller) converts a caller taking some parameters
+    before the function, i.e. caller(param, ..., func, *args, **kw), into
+    a factory of decorators with the signature (param, ...): the factory
+    is generated once, while the decorators it returns are closures, so
+    that no code is generated for each combination of the parameters.
+    """
+    if not inspect.isfunction(caller):
+        raise TypeError('You are using a non function: %s' % caller)
+    params = getfullargspec(caller).args[:-1]  # the last one is the func
+    name = '_lambda_' if caller.__name__ == '<lambda>' else caller.__name__
+    partial = functools.partial
+
+    def make(*params):
+        "Return the decorator with the given parameters"
+        call = partial(caller, *params)
+
+        def dec(func):
+            return decorate(func, call, mode)
+        dec.__name__ = name
+        dec.__doc__ = caller.__doc__
+        dec.__module__ = caller.__module__
+        dec.__wrapped__ = call
+        return dec
+    return FunctionMaker.create(
+        '%s(%s)' % (name, ', '.join(params)),
+        'return _make_(%s)' % ', '.join(params), dict(_make_=make),
+        doc=caller.__doc__, module=caller.__module__)
 
 
 # ####################### contextmanager ####################### #
@@ -330,11 +1344,14 @@ def dispatch_on(*dispatch_args):
         """Decorator turning a function into a generic function"""
 
         # first check the dispatch arguments
-        argset = set(getfullargspec(func).args)
+        argset = set(getfullargspec(_materialized(func)).args)
         if not set(dispatch_args) <= argset:
             raise NameError('Unknown dispatch arguments %s' % dispatch_str)
 
+        # typemap is read without locking by the dispatcher; registrations
+        # are serialized by the lock and readers iterate over a snapshot
         typemap = {}
+        lock = threading.Lock()
 
         def vancestors(*types):
             """
@@ -342,7 +1359,7 @@ def dispatch_on(*dispatch_args):
             """
             check(types)
             ras = [[] for _ in range(len(dispatch_args))]
-            for types_ in typemap:
+            for types_ in list(typemap):
                 for t, type_, ra in zip(types, types_, ras):
                     if issubclass(t, type_) and type_ not in t.__mro__:
                         append(type_, ra)
@@ -374,7 +1391,8 @@ def dispatch_on(*dispatch_args):
             check(types)
             def dec(f):
                 check(getfullargspec(f).args, operator.lt, ' in ' + f.__name__)
-                typemap[types] = f
+                with lock:
+                    typemap[types] = f
                 return f
             return dec
 
@@ -414,3 +1432,562 @@ def dispatch_on(*dispatch_args):
 
     gen_func_dec.__name__ = 'dispatch_on' + dispatch_str
     return gen_func_dec
+
+# ############################# metrics ############################### #
+
+class Metrics(object):
+    """
+    Number of calls, number of errors and histogram of the latencies of a
+    function. The histogram has a fixed number of buckets: the bucket i
+    counts the calls lasting less than unit * 2 ** i seconds and the last
+    bucket counts the longer calls.
+    """
+    registry = {}  # name -> Metrics for the functions decorated by metered
+
+    def __init__(self, name, nbuckets=25, unit=1E-6):
+        self.name = name
+        self.unit = unit
+        self.buckets = [0] * (nbuckets + 1)
+        self._scale = 1. / unit  # precomputed for record
+        self._last = nbuckets
+        self.sum = 0.
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self):
+        return sum(self.buckets)
+
+    def bounds(self):
+        "Return the upper bounds of the buckets in seconds"
+        n = len(self.buckets) - 1
+        return [self.unit * 2 ** i for i in range(n)] + [float('inf')]
+
+    def record(self, seconds, error=False):
+        "Record a call lasting the given seconds"
+        i = int(seconds * self._scale).bit_length()
+        if i > self._last:
+            i = self._last
+        with self._lock:
+            self.buckets[i] += 1
+            self.sum += seconds
+            if error:
+                self.errors += 1
+
+    def snapshot(self):
+        "Return a consistent copy of the metrics"
+        new = self.__class__(self.name, len(self.buckets) - 1, self.unit)
+        with self._lock:
+            new.buckets[:] = self.buckets
+            new.sum = self.sum
+            new.errors = self.errors
+        return new
+
+    def merge(self, other):
+        "Add the counts of other, which must have the same buckets"
+        if (other.unit, len(other.buckets)) != (self.unit, len(self.buckets)):
+            raise ValueError('Cannot merge histograms with different buckets')
+        other = other.snapshot()
+        with self._lock:
+            for i, n in enumerate(other.buckets):
+                self.buckets[i] += n
+            self.sum += other.sum
+            self.errors += other.errors
+        return self
+
+    def _samples(self, prefix):
+        "Return the histogram samples and the error sample for Prometheus"
+        snap = self.snapshot()
+        label = 'function="%s"' % snap.name.replace('\\', r'\\').replace(
+            '"', r'\"')
+        lines, total = [], 0
+        for bound, n in zip(snap.bounds(), snap.buckets):
+            total += n
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('%s_seconds_bucket{%s,le="%s"} %d' %
+                         (prefix, label, le, total))
+        lines.append('%s_seconds_sum{%s} %r' % (prefix, label, snap.sum))
+        lines.append('%s_seconds_count{%s} %d' % (prefix, label, total))
+        return lines, '%s_errors_total{%s} %d' % (prefix, label, snap.errors)
+
+
+# the caller of metered for coroutine functions and generators: the
+# latency is the time until the function returns, i.e. until the coroutine
+# is done or the generator is exhausted (including the time spent by the
+# consumer between the items)
+_METERED = '''\
+%s caller(func, *args, **kw):
+    t0 = _timer()
+    try:
+        %s
+    except _closed:  # closed or cancelled early, not an error
+        record(_timer() - t0)
+        raise
+    except Exception:
+        record(_timer() - t0, True)
+        raise
+    record(_timer() - t0)
+    %s
+'''
+
+
+def _metered_caller(func, record):
+    "Return the caller of metered for a coroutine function or a generator"
+    closed = (GeneratorExit,)
+    if _iscoroutinefunction(func) or _isasyncgenfunction(func):
+        import asyncio
+        closed += (asyncio.CancelledError,)
+    if _iscoroutinefunction(func):
+        parts = 'async def', 'result = await func(*args, **kw)', \
+            'return result'
+    elif _isasyncgenfunction(func):
+        parts = ('async def', 'async for item in func(*args, **kw):\n'
+                 '            yield item', '')
+    elif _YIELD_FROM:
+        parts = 'def', 'result = yield from func(*args, **kw)', \
+            'return result'
+    else:  # no yield from and no return with a value in a generator
+        parts = ('def', 'for item in func(*args, **kw):\n'
+                 '            yield item', '')
+    evaldict = dict(_timer=_timer, record=record, _closed=closed)
+    exec(_METERED % parts, evaldict)
+    return evaldict['caller']
+
+
+def metered(func, name=None):
+    """
+    metered(func) decorates func so that its calls are recorded by a
+    Metrics object, available as the attribute __metrics__ and stored in
+    Metrics.registry with the given name (by default module.qualname).
+    Functions decorated with the same name share the same metrics. For a
+    coroutine function the time until the coroutine is done is recorded,
+    for a generator function the time until the generator is exhausted.
+    """
+    if name is None:
+        name = '%s.%s' % (func.__module__,
+                          getattr(func, '__qualname__', func.__name__))
+    metrics = Metrics.registry.get(name)
+    if metrics is None:
+        with FunctionMaker._lock:
+            metrics = Metrics.registry.setdefault(name, Metrics(name))
+    record = metrics.record
+
+    def caller(func, *args, **kw):
+        t0 = _timer()
+        try:
+            result = func(*args, **kw)
+        except:
+            record(_timer() - t0, True)
+            raise
+        record(_timer() - t0)
+        return result
+    if (_iscoroutinefunction(func) or _isasyncgenfunction(func) or
+            inspect.isgeneratorfunction(func)):
+        caller = _metered_caller(func, record)
+    fun = decorate(func, caller)
+    fun.__metrics__ = metrics
+    return fun
+
+
+def prometheus_text(metrics=None, prefix='decorator_call'):
+    """
+    Return the given metrics (by default the ones in Metrics.registry)
+    in the Prometheus text format
+    """
+    if metrics is None:
+        metrics = sorted(Metrics.registry.values(), key=lambda m: m.name)
+    latencies, errors = [], []
+    for m in metrics:
+        lines, error = m._samples(prefix)
+        latencies.extend(lines)
+        errors.append(error)
+    return '\n'.join(
+        ['# HELP %s_seconds Latency of the calls.' % prefix,
+         '# TYPE %s_seconds histogram' % prefix] + latencies +
+        ['# HELP %s_errors_total Calls raising an exception.' % prefix,
+         '# TYPE %s_errors_total counter' % prefix] + errors) + '\n'
+
+
+def dump_metrics(path, metrics=None, prefix='decorator_call'):
+    """
+    Write the given metrics (by default the ones in Metrics.registry) in
+    the Prometheus text format in path, atomically replacing the file
+    """
+    text = prometheus_text(metrics, prefix)
+    dirname = os.path.dirname(os.path.abspath(path))
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write(text)
+        getattr(os, 'replace', os.rename)(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+# ############################# tracing ############################### #
+
+# PEP 669, Python 3.12+
+_MONITORING = getattr(sys, 'monitoring', None)
+
+Span = collections.namedtuple('Span', 'name thread start end status')
+
+
+class Tracer(object):
+    """
+    Record the calls of the traced functions as spans (name, thread id,
+    start time, end time, status) in a ring buffer of the given size,
+    which keeps the most recent spans. On Python 3.12+ the functions are
+    observed with sys.monitoring and not wrapped: while tracing is
+    disabled calling them costs nothing. On older Pythons they are
+    wrapped with decorate and the caller checks if tracing is enabled.
+    A function can be enabled in a single tracer at the same time.
+    """
+    # id of the code of the enabled functions (or of the functions
+    # themselves, without sys.monitoring) -> (tracer, name, code or
+    # function, original code), shared by all the tracers, since they
+    # share a single sys.monitoring tool id
+    _codes = {}
+    _tool = None
+
+    def __init__(self, size=4096):
+        self.size = size
+        self._buffer = [None] * size
+        self._count = itertools.count()
+
+    def trace(self, func, enabled=True):
+        """
+        Return func (on Python 3.12+) or a decorated function recording
+        a span for each call in the ring buffer, if enabled. On Python
+        3.12+ the code object of func is replaced by a copy while tracing
+        is enabled, so that the closures sharing it are not traced.
+        """
+        if _MONITORING is None:
+            fun = decorate(func, self._caller(func))
+            fun.__traced__ = func
+        else:
+            fun = func
+        if enabled:
+            self.enable(fun)
+        return fun
+
+    def enable(self, fun):
+        "Start recording the calls of a traced function"
+        func = getattr(fun, '__traced__', fun)
+        name = '%s.%s' % (func.__module__,
+                          getattr(func, '__qualname__', func.__name__))
+        with FunctionMaker._lock:
+            key = id(func if _MONITORING is None else func.__code__)
+            entry = self._codes.get(key)
+            if entry is not None:
+                if entry[0] is not self:
+                    raise ValueError('%s is traced by another tracer' % name)
+                return
+            if _MONITORING is None:
+                self._codes[key] = self, name, func, None
+                return
+            # the events are enabled per code object: a private copy
+            # keeps out the other closures sharing the code of func
+            orig = func.__code__
+            code = func.__code__ = orig.replace()
+            self._codes[id(code)] = self, name, code, orig
+            tool = self._usetool()
+            _MONITORING.set_local_events(tool, code, _EVENTS)
+            _MONITORING.set_events(tool, _EVENTS_GLOBAL)
+
+    def disable(self, fun):
+        "Stop recording the calls of a traced function"
+        func = getattr(fun, '__traced__', fun)
+        with FunctionMaker._lock:
+            key = id(func if _MONITORING is None else func.__code__)
+            entry = self._codes.get(key)
+            if entry is None or entry[0] is not self:
+                return
+            del self._codes[key]
+            if _MONITORING is not None:
+                _MONITORING.set_local_events(self._tool, entry[2], 0)
+                func.__code__ = entry[3]  # restore the original code
+                if not self._codes:
+                    _MONITORING.set_events(self._tool, 0)
+
+    @classmethod
+    def _usetool(cls):
+        "Return the sys.monitoring tool id, reserving it the first time"
+        if cls._tool is None:
+            for tool in range(5, -1, -1):
+                if _MONITORING.get_tool(tool) is None:
+                    break
+            else:
+                raise RuntimeError('All the sys.monitoring tool ids are used')
+            _MONITORING.use_tool_id(tool, 'decorator')
+            for event, callback in _CALLBACKS.items():
+                _MONITORING.register_callback(tool, event, callback)
+            cls._tool = tool
+        return cls._tool
+
+    def _caller(self, func):
+        "Return a caller recording the spans of func when enabled"
+        codes, key = self._codes, id(func)
+
+        def caller(func, *args, **kw):
+            entry = codes.get(key)
+            if entry is None:
+                return func(*args, **kw)
+            start = _timer()
+            try:
+                result = func(*args, **kw)
+            except:
+                entry[0]._write(Span(entry[1], _get_ident(), start, _timer(),
+                                     'raise'))
+                raise
+            entry[0]._write(Span(entry[1], _get_ident(), start, _timer(),
+                                 'return'))
+            return result
+        return caller
+
+    def _write(self, span):
+        self._buffer[next(self._count) % self.size] = span
+
+    def spans(self):
+        "Return the spans in the ring buffer, ordered by end time"
+        return sorted((span for span in self._buffer if span is not None),
+                      key=operator.attrgetter('end'))
+
+    def clear(self):
+        "Remove all the spans from the ring buffer"
+        self._buffer[:] = [None] * self.size
+
+    def dump(self, file=None):
+        "Print the spans in the ring buffer on file (default sys.stdout)"
+        for span in self.spans():
+            print('%.6f %10.1f us %s %s %s' % (
+                span.start, (span.end - span.start) * 1E6, span.thread,
+                span.name, span.status), file=file or sys.stdout)
+
+
+if _MONITORING is not None:
+    _starts = threading.local()  # stack of (code, start time) per thread
+
+    def _on_start(code, offset):
+        try:
+            stack = _starts.stack
+        except AttributeError:
+            stack = _starts.stack = []
+        stack.append((code, _timer()))
+
+    def _on_throw(code, offset, exc):
+        if id(code) in Tracer._codes:  # PY_THROW is global
+            _on_start(code, offset)
+
+    def _on_end(status):
+        def on_end(code, offset, value):
+            entry = Tracer._codes.get(id(code))
+            if entry is None:  # PY_UNWIND is global
+                return
+            end = _timer()
+            stack = getattr(_starts, 'stack', None)
+            # the start is missing if tracing was enabled during the call
+            if stack and stack[-1][0] is code:
+                tracer, name = entry[:2]
+                tracer._write(Span(name, _get_ident(), stack.pop()[1], end,
+                                   status))
+        return on_end
+
+    _E = _MONITORING.events
+    _EVENTS = _E.PY_START | _E.PY_RESUME | _E.PY_RETURN | _E.PY_YIELD
+    # these cannot be enabled for a single code
+    _EVENTS_GLOBAL = _E.PY_THROW | _E.PY_UNWIND
+    _CALLBACKS = {_E.PY_START: _on_start, _E.PY_RESUME: _on_start,
+                  _E.PY_THROW: _on_throw,
+                  _E.PY_RETURN: _on_end('return'),
+                  _E.PY_YIELD: _on_end('yield'),
+                  _E.PY_UNWIND: _on_end('raise')}
+
+tracer = Tracer()
+traced = tracer.trace
+
+
+# ########################### normalizers ############################## #
+
+def _params_tuple(maker, varkw='%s'):
+    """
+    Return the expression of the tuple of the parameters of a maker; the
+    **kw parameter is formatted with varkw
+    """
+    names = list(maker.args)
+    if maker.varargs:
+        names.append(maker.varargs)
+    names.extend(maker.kwonlyargs or ())
+    if maker.varkw:
+        names.append(varkw % maker.varkw)
+    return '(%s,)' % ', '.join(names) if names else '()'
+
+
+_normalizers = weakref.WeakKeyDictionary()  # func -> normalizer
+
+
+def normalizer(func):
+    """
+    normalizer(func) returns a function with the signature of func
+    returning the tuple of the values of the parameters, in the order of
+    the signature, defaults included; *args is passed as a tuple and
+    **kw as a dictionary. The wrong arguments raise the same TypeError as
+    func. The normalizer is generated once for each function.
+    """
+    norm = _normalizers.get(func)
+    if norm is None:
+        maker = FunctionMaker(func)
+        norm = maker.make(_template('return ' + _params_tuple(maker)), {},
+                          True)
+        with FunctionMaker._lock:
+            norm = _normalizers.setdefault(func, norm)
+    return norm
+
+
+# ############################# memoize ################################ #
+
+MemoInfo = collections.namedtuple(
+    'MemoInfo', 'hits misses evictions currsize maxsize')
+
+# OrderedDict.move_to_end is missing in Python 2
+_move_to_end = getattr(collections.OrderedDict, 'move_to_end',
+                       lambda data, key: data.__setitem__(key, data.pop(key)))
+
+
+class Memo(object):
+    """
+    The cache of a function decorated by memoize, mapping the values of
+    the parameters to the results. When there are more than maxsize
+    entries (if maxsize is not None) the least recently used one is
+    evicted; if ttl is not None the entries expire after ttl seconds.
+    """
+    def __init__(self, maxsize=128, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.data = collections.OrderedDict()  # key -> (value, expiry)
+        self.hits = self.misses = self.evictions = 0
+        self._lock = threading.RLock()  # the keys may call Python code
+
+    def get(self, key, default=None):
+        "Return the value for key, if not expired, or default"
+        # acquire/release is much faster than a with block (on the hot path)
+        self._lock.acquire()
+        try:
+            try:
+                value, expiry = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expiry is not None and expiry <= _timer():
+                del self.data[key]
+                self.evictions += 1
+                self.misses += 1
+                return default
+            _move_to_end(self.data, key)
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def put(self, key, value):
+        "Store the value for key, evicting the oldest entry if needed"
+        expiry = None if self.ttl is None else _timer() + self.ttl
+        self._lock.acquire()
+        try:
+            self.data[key] = value, expiry
+            _move_to_end(self.data, key)  # if it was already there
+            if self.maxsize is not None and len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def info(self):
+        "Return the statistics of the cache as a MemoInfo namedtuple"
+        with self._lock:
+            return MemoInfo(self.hits, self.misses, self.evictions,
+                            len(self.data), self.maxsize)
+
+    def clear(self):
+        "Remove all the entries and reset the statistics"
+        with self._lock:
+            self.data.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+def _single_flight(memo, exceptions):
+    """
+    Return a function calling a factory of coroutines at most once at the
+    same time for each key and event loop: the concurrent calls await the
+    same task, shielded, so that cancelling one of them does not cancel
+    the task. The finished tasks are stored in memo, unless they were
+    cancelled or they failed and exceptions is false.
+    """
+    import asyncio
+    get_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+    flights = weakref.WeakKeyDictionary()  # loop -> {key: task}
+
+    def done(tasks, key, task):
+        if tasks.get(key) is task:
+            del tasks[key]
+        if not task.cancelled() and (exceptions or task.exception() is None):
+            memo.put(key, task)
+
+    def call(key, factory):
+        loop = get_loop()
+        tasks = flights.get(loop)
+        if tasks is None:
+            with FunctionMaker._lock:
+                tasks = flights.setdefault(loop, {})
+        task = tasks.get(key)
+        if task is None:
+            task = tasks[key] = loop.create_task(factory())
+            task.add_done_callback(functools.partial(done, tasks, key))
+        return asyncio.shield(task)
+    return call
+
+
+def memoize(func=None, maxsize=128, ttl=None, exceptions=False):
+    """
+    memoize(func) decorates func so that the results are cached in a Memo
+    object, available as the attribute __memo__, with the given maxsize
+    and ttl. The keys are the values of the parameters in the order of the
+    signature, defaults included, so that f(1) and f(x=1) share the same
+    entry; the arguments must be hashable. memoize(maxsize=..., ttl=...)
+    returns a decorator. If func is a coroutine function, the concurrent
+    calls with the same key share a single call of func, and the
+    exceptions are cached too if exceptions is true.
+    """
+    if func is None:
+        return functools.partial(memoize, maxsize=maxsize, ttl=ttl,
+                                 exceptions=exceptions)
+    if inspect.isgeneratorfunction(func) or _isasyncgenfunction(func):
+        raise TypeError('Cannot memoize %s: the generators it returns '
+                        'cannot be reused' % func)
+    memo = Memo(maxsize, ttl)
+    maker = FunctionMaker(func)
+    key = _params_tuple(maker, 'tuple(sorted(%s.items()))')
+    if _iscoroutinefunction(func):
+        # the cache contains the finished tasks
+        body = ('_key_ = %s\n'
+                '_value_ = _memo_.get(_key_)\n'
+                'if _value_ is None:\n'
+                '    return await _flight_(\n'
+                '        _key_, lambda: _func_(%%(shortsignature)s))\n'
+                'return _value_.result()' % key)
+        evaldict = dict(_memo_=memo, _func_=func,
+                        _flight_=_single_flight(memo, exceptions))
+    else:
+        body = ('_key_ = %s\n'
+                '_value_ = _memo_.get(_key_, _memo_)\n'
+                'if _value_ is _memo_:\n'
+                '    _value_ = _func_(%%(shortsignature)s)\n'
+                '    _memo_.put(_key_, _value_)\n'
+                'return _value_' % key)
+        evaldict = dict(_memo_=memo, _func_=func)
+    fun = maker.make(_template(body, _iscoroutinefunction(func)), evaldict,
+                     True, __wrapped__=func)
+    if hasattr(func, '__qualname__'):
+        fun.__qualname__ = func.__qualname__
+    fun.__memo__ = memo
+    return fun
@@ -0,0 +1,492 @@
+"""
+Benchmarks of the decorator module. Run them from the src directory with
+
+  $ python -m tests.benchmark [-o results.json] [-b baseline.json]
+
+The results (nanoseconds per call, or bytes per object for the memory
+benchmarks) are printed as a table and can be saved in JSON format; when
+a baseline saved by a previous run is given, the exit status is 1 if any
+benchmark is slower than the baseline by more than the threshold. The
+numbers depend on the machine, so the baseline should come from the same
+machine and interpreter.
+"""
+from __future__ import print_function
+import gc
+import sys
+import json
+import inspect
+import timeit
+import argparse
+import platform
+import functools
+import contextlib
+import collections
+import decorator
+from decorator import (decorator as decorator_, decorate, decorate_many,
+                       decorator_factory, contextmanager, dispatch_on,
+                       metered, memoize, normalizer, Metrics, Tracer,
+                       FunctionMaker, ItemCaller)
+
+# signature shapes of the decorated functions, with the arguments of a call
+SHAPES = collections.OrderedDict([
+    ('positional', ('a, b', (1, 2), {})),
+    ('defaults', ('a, b=1, c=2', (1,), {})),
+    ('varargs', ('a, *args', (1, 2, 3), {})),
+    ('kwonly', ('a, *, b=1', (1,), {'b': 2})),
+    ('varkw', ('a, **kw', (1,), {'b': 2})),
+])
+
+MODES = ('exec', 'closure', 'shared', 'lazy', 'light', 'inline', 'fuse')
+
+BENCHMARKS = collections.OrderedDict()  # name -> (function, unit, per)
+
+
+def benchmark(name, unit='ns', per=1):
+    """
+    Register a benchmark function returning a callable to be timed; per is
+    the number of operations performed by each call of the callable
+    """
+    def register(func):
+        BENCHMARKS[name] = func, unit, per
+        return func
+    return register
+
+
+def do_nothing(func, *args, **kw):
+    "a caller simple enough to be inlined"
+    return func(*args, **kw)
+
+
+def make_function(shape, name='f', prefix=''):
+    "Return a function (or a coroutine function) doing nothing"
+    dic = {}
+    exec('%sdef %s(%s):\n    pass\n' % (prefix, name, SHAPES[shape][0]),
+         dic)
+    return dic[name]
+
+
+def call(func, shape):
+    "Return a callable calling func with the arguments of the shape"
+    _, args, kw = SHAPES[shape]
+    if kw:
+        return lambda: func(*args, **kw)
+    return lambda: func(*args)
+
+
+# ########################### decoration ############################### #
+
+def _decoration(mode):
+    f = make_function('defaults')
+    return lambda: decorate(f, do_nothing, mode)
+
+
+for _mode in MODES:
+    benchmark('decorate/' + _mode)(
+        lambda mode=_mode: _decoration(mode))
+
+
+@benchmark('decorator/exec')
+def _decorator():
+    dec = decorator_(do_nothing)
+    f = make_function('defaults')
+    return lambda: dec(f)
+
+
+@benchmark('decorator/same-caller')
+def _decorator_same_caller():
+    return lambda: decorator_(do_nothing)
+
+
+@benchmark('decorator/new-caller')
+def _decorator_new_caller():
+    def make():
+        def caller(func, *args, **kw):
+            return func(*args, **kw)
+        return decorator_(caller)
+    return make
+
+
+@benchmark('decorator_factory/params')
+def _decorator_factory():
+    def caller(param, func, *args, **kw):
+        return func(*args, **kw)
+    factory = decorator_factory(caller)
+    return lambda: factory(1)
+
+
+@benchmark('decorate_many/100')
+def _decorate_many():
+    funcs = [make_function('defaults', 'f%d' % i) for i in range(100)]
+    return lambda: decorate_many(funcs, do_nothing)
+
+
+@benchmark('create/100')
+def _create():
+    specs = [('f%d(a, b, c)' % i, 'return a + b + c + %d' % i)
+             for i in range(100)]
+    return lambda: [FunctionMaker.create(obj, body, {})
+                    for obj, body in specs]
+
+
+@benchmark('create_many/100')
+def _create_many():
+    specs = [('f%d(a, b, c)' % i, 'return a + b + c + %d' % i)
+             for i in range(100)]
+    return lambda: FunctionMaker.create_many(specs, {})
+
+
+# ############################# calls ################################## #
+
+for _shape in SHAPES:
+    benchmark('call/%s/undecorated' % _shape)(
+        lambda shape=_shape: call(make_function(shape), shape))
+    benchmark('call/%s/exec' % _shape)(
+        lambda shape=_shape: call(
+            decorate(make_function(shape), do_nothing), shape))
+
+for _mode in MODES[1:]:
+    benchmark('call/positional/' + _mode)(
+        lambda mode=_mode: call(
+            decorate(make_function('positional'), do_nothing, mode),
+            'positional'))
+
+
+@benchmark('call/positional/metered')
+def _metered():
+    f = metered(make_function('positional'), 'benchmark.f')
+    del Metrics.registry['benchmark.f']
+    return call(f, 'positional')
+
+
+@benchmark('call/defaults/memoize-hit')
+def _memoize_hit():
+    f = memoize(make_function('defaults'))
+    return call(f, 'defaults')
+
+
+@benchmark('call/defaults/lru_cache-hit')
+def _lru_cache_hit():
+    if not hasattr(functools, 'lru_cache'):
+        raise ImportError('functools.lru_cache is missing')
+    f = functools.lru_cache()(make_function('defaults'))
+    return call(f, 'defaults')
+
+
+def _traced(enabled):
+    tracer = Tracer()
+    return call(tracer.trace(make_function('positional'), enabled),
+                'positional')
+
+
+benchmark('call/positional/traced-off')(lambda: _traced(False))
+benchmark('call/positional/traced-on')(lambda: _traced(True))
+
+
+def _method(mode=None):
+    "Return a function calling a method of an instance"
+    class C(object):
+        def f(self, a, b):
+            pass
+    if mode == 'method':  # decorate the class
+        decorate(C, do_nothing, mode)
+    elif mode:
+        C.f = decorate(vars(C)['f'], do_nothing, mode)
+    obj = C()
+    return lambda: obj.f(1, 2)
+
+
+benchmark('call/method/undecorated')(lambda: _method())
+for _mode in ('exec', 'light', 'method'):
+    benchmark('call/method/' + _mode)(lambda mode=_mode: _method(mode))
+
+
+def _layers(mode, n=5):
+    dec = decorator_(do_nothing, mode=mode)
+    f = make_function('positional')
+    for _ in range(n):
+        f = dec(f)
+    return call(f, 'positional')
+
+
+benchmark('call/5-layers/exec')(lambda: _layers('exec'))
+benchmark('call/5-layers/fuse')(lambda: _layers('fuse'))
+
+
+# ########################### normalizers ############################## #
+
+def _bind(func):
+    "Return a function normalizing the arguments with Signature.bind"
+    if not hasattr(inspect, 'signature'):
+        raise ImportError('inspect.signature is missing')
+    bind = inspect.signature(func).bind
+
+    def normalize(*args, **kw):
+        bound = bind(*args, **kw)
+        bound.apply_defaults()
+        return tuple(bound.arguments.values())
+    return normalize
+
+
+for _shape in SHAPES:
+    benchmark('normalize/%s/normalizer' % _shape)(
+        lambda shape=_shape: call(normalizer(make_function(shape)), shape))
+    benchmark('normalize/%s/Signature.bind' % _shape)(
+        lambda shape=_shape: call(_bind(make_function(shape)), shape))
+
+
+# ########################### coroutines ############################### #
+
+async_do_nothing = None  # defined below if async def is supported
+try:
+    exec('''
+async def async_do_nothing(func, *args, **kw):
+    return await func(*args, **kw)
+
+
+async def _await_many(func, n):
+    for _ in range(n):
+        await func(1, 2)
+''')
+except SyntaxError:  # old Python
+    pass
+
+
+def _async_calls(mode=None, caller=None, n=1000):
+    "Return a function awaiting n calls of a coroutine in an event loop"
+    import asyncio
+    if async_do_nothing is None:
+        raise SyntaxError('async def is not supported')
+    f = make_function('positional', prefix='async ')
+    if mode:
+        f = decorate(f, caller or async_do_nothing, mode)
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(_await_many(f, n))
+
+
+benchmark('await/positional/undecorated', per=1000)(lambda: _async_calls())
+for _mode in ('exec', 'closure', 'shared'):
+    benchmark('await/positional/' + _mode, per=1000)(
+        lambda mode=_mode: _async_calls(mode))
+benchmark('await/positional/exec-sync-caller', per=1000)(
+    lambda: _async_calls('exec', do_nothing))
+
+
+@benchmark('await/positional/memoize-hit', per=1000)
+def _memoize_async():
+    import asyncio
+    if async_do_nothing is None:
+        raise SyntaxError('async def is not supported')
+    f = memoize(make_function('positional', prefix='async '))
+    loop = asyncio.new_event_loop()
+    return lambda: loop.run_until_complete(_await_many(f, 1000))
+
+
+# ############################ generators ############################## #
+
+def numbers(n):
+    for i in range(n):
+        yield i
+
+
+def _iterate(f, n=1000):
+    "Return a function consuming the n items produced by f"
+    def run():
+        for _ in f(n):
+            pass
+    return run
+
+
+def _generator_caller():
+    "Return a caller yielding from the generator, if yield from is supported"
+    dic = {}
+    exec('def caller(f, *args, **kw):\n'
+         '    return (yield from f(*args, **kw))\n', dic)
+    return dic['caller']
+
+
+benchmark('iterate/undecorated', per=1000)(lambda: _iterate(numbers))
+benchmark('iterate/exec', per=1000)(
+    lambda: _iterate(decorate(numbers, _generator_caller())))
+benchmark('iterate/items', per=1000)(
+    lambda: _iterate(decorate(numbers, ItemCaller())))
+
+
+# ########################## contextmanager ############################ #
+
+def before_after():
+    yield
+
+
+@benchmark('contextmanager/with')
+def _with():
+    ctx = contextmanager(before_after)
+
+    def run():
+        with ctx():
+            pass
+    return run
+
+
+@benchmark('contextmanager/with/contextlib')
+def _with_contextlib():
+    ctx = contextlib.contextmanager(before_after)
+
+    def run():
+        with ctx():
+            pass
+    return run
+
+
+@benchmark('contextmanager/decorated-call')
+def _decorated_call():
+    ctx = contextmanager(before_after)
+    f = make_function('positional')
+    return lambda: ctx()(f)(1, 2)
+
+
+# ############################ dispatch_on ############################# #
+
+def _generic():
+    @dispatch_on('obj')
+    def show(obj):
+        return 'object'
+
+    @show.register(int)
+    def show_int(obj):
+        return 'int'
+    return show
+
+
+@benchmark('dispatch/hit')
+def _dispatch_hit():
+    show = _generic()
+    return lambda: show(1)
+
+
+@benchmark('dispatch/miss')
+def _dispatch_miss():
+    show = _generic()  # bool is found through the MRO
+    return lambda: show(True)
+
+
+@benchmark('dispatch/default')
+def _dispatch_default():
+    show = _generic()
+    return lambda: show('')
+
+
+# ############################# memory ################################# #
+
+def _memory(make, n=10000):
+    "Return a function measuring the bytes allocated for each object"
+    def measure():
+        import tracemalloc
+        gc.collect()
+        tracemalloc.start()
+        try:
+            objs = [make(i) for i in range(n)]
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        del objs
+        return size / float(n)
+    return measure
+
+
+@benchmark('memory/maker', 'B')
+def _memory_maker():
+    f = make_function('defaults')
+    return _memory(lambda i: FunctionMaker(f))
+
+
+for _mode in ('exec', 'closure', 'shared'):
+    benchmark('memory/decorated/' + _mode, 'B')(
+        lambda mode=_mode: _memory(
+            lambda i: decorate(make_function('defaults'), do_nothing, mode)))
+
+
+# ############################## runner ################################ #
+
+def measure(func, repeat, min_time=.1):
+    "Return the best time in nanoseconds per call of func"
+    timer = timeit.Timer(func)
+    number = 1
+    while timer.timeit(number) < min_time:  # calibrate
+        number *= 10
+    return min(timer.repeat(repeat, number)) / number * 1E9
+
+
+def run(names, repeat):
+    "Run the given benchmarks and return a dictionary name -> result"
+    results = collections.OrderedDict()
+    for name in names:
+        func, unit, per = BENCHMARKS[name]
+        try:
+            bench = func()
+            value = (bench() if unit == 'B' else measure(bench, repeat)) / per
+        except (SyntaxError, ImportError, ValueError) as exc:
+            print('%-36s skipped: %s' % (name, exc), file=sys.stderr)
+            continue
+        results[name] = dict(value=value, unit=unit)
+    return results
+
+
+def compare(results, baseline, threshold):
+    "Print the results with the ratio to the baseline; return the regressions"
+    regressions = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        line = '%-36s %10.1f %-2s' % (name, res['value'], res['unit'])
+        if base:
+            ratio = res['value'] / base['value']
+            line += ' %10.1f %-2s %5.2fx' % (base['value'], base['unit'],
+                                            ratio)
+            if ratio > 1 + threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        print(line)
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m tests.benchmark', description=__doc__.split('\n')[1])
+    parser.add_argument('names', nargs='*',
+                        help='run only the benchmarks starting with a name')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('-b', '--baseline', help='JSON results to compare')
+    parser.add_argument('-t', '--threshold', type=float, default=.1,
+                        help='tolerated slowdown (default 0.1, i.e. 10%%)')
+    parser.add_argument('-r', '--repeat', type=int, default=5,
+                        help='repetitions of each timing (default 5)')
+    parser.add_argument('-l', '--list', action='store_true',
+                        help='list the benchmarks and exit')
+    args = parser.parse_args(argv)
+    names = [name for name in BENCHMARKS if not args.names or
+             any(name.startswith(n) for n in args.names)]
+    if args.list:
+        print('\n'.join(names))
+        return 0
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)['results']
+    results = run(names, args.repeat)
+    regressions = compare(results, baseline, args.threshold)
+    if args.output:
+        data = dict(python=sys.version.split()[0],
+                    implementation=platform.python_implementation(),
+                    platform=platform.platform(),
+                    decorator=decorator.__version__,
+                    results=results)
+        with open(args.output, 'w') as f:
+            json.dump(data, f, indent=1)
+    if regressions:
+        print('%d regression(s) over %d%%: %s' % (
+            len(regressions), args.threshold * 100, ', '.join(regressions)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -250,6 +250,62 @@ The signature of ``heavy_computation`` is the one you would expect:
  >>> print(getargspec(heavy_computation))
  ArgSpec(args=[], varargs=None, varkw=None, defaults=None)
 
+The ``memoize`` above is just an example: its cache grows forever and
+its keys depend on how the arguments are passed, so that ``f(1)`` and
+``f(x=1)`` are cached twice. The ``decorator`` module provides a ready
+made ``memoize`` (imported here as ``cached``, not to clash with the
+example) building the keys from the values of the parameters, defaults
+included, in the order of the signature. The cache is a ``Memo`` object,
+available as the attribute ``__memo__``, evicting the least recently
+used entry when it has more than ``maxsize`` entries (128 by default,
+``None`` means no limit) and discarding the entries older than ``ttl``
+seconds, if given. It can be used by many threads at the same time:
+
+.. code-block:: python
+
+ >>> from decorator import memoize as cached
+ >>> @cached(maxsize=1000, ttl=60)
+ ... def power(x, n=2):
+ ...     return x ** n
+
+ >>> power(3), power(x=3), power(3, n=2)
+ (9, 9, 9)
+ >>> power.__memo__.info()
+ MemoInfo(hits=2, misses=1, evictions=0, currsize=1, maxsize=1000)
+
+``memoize`` works with coroutine functions too: the decorated function
+is a coroutine function and the concurrent calls with the same arguments
+share a single call of the original function (the other callers await
+its result), so that a backend is hit once even by hundreds of tasks
+asking for the same key at the same time. Cancelling one of the callers
+does not cancel the shared call, which keeps running for the other ones
+and fills the cache. The exceptions are not cached, unless
+``exceptions=True`` is passed:
+
+.. code-block:: python
+
+ @memoize(maxsize=10000, ttl=30, exceptions=True)
+ async def get_user(user_id):
+     async with session.get('/users/%d' % user_id) as resp:
+         return await resp.json()
+
+The same normalization is available to any caller needing the values of
+the parameters, for instance for logging or authorization:
+``normalizer(func)`` returns a function generated once for ``func``, with
+the same signature, returning the tuple of the values of the parameters
+in the order of the signature, defaults included (``*args`` is a tuple
+and ``**kw`` a dictionary). It is much faster than
+``inspect.signature(func).bind(*args, **kw)``:
+
+.. code-block:: python
+
+ >>> from decorator import normalizer
+ >>> def query(table, limit=10, *columns, **filters):
+ ...     pass
+ >>> normalizer(query)('users', columns=None) == (
+ ...     'users', 10, (), {'columns': None})
+ True
+
 A ``trace`` decorator
 ------------------------------------------------------
 
@@ -383,6 +439,26 @@ available. For instance:
  >>> print(read_data())
  some data
 
+Notice that each call to ``blocking`` generates a new decorator, since
+the caller ``_blocking`` is a new closure every time; ``decorator`` can
+only reuse the decorators generated for the same caller. When a family
+of decorators is used many times, it is better to write the caller
+with the parameters before the function and to convert it with
+``decorator_factory``, which generates the factory once; the decorators
+returned by the factory are simple closures:
+
+.. code-block:: python
+
+ >>> from decorator import decorator_factory
+ >>> def tagged(tag, func, *args, **kw):
+ ...     return '%s %s' % (tag, func(*args, **kw))
+ >>> tagged = decorator_factory(tagged)
+ >>> @tagged('result:')
+ ... def add(x, y=1):
+ ...     return x + y
+ >>> add(1)
+ 'result: 2'
+
 ``decorator(cls)``
 --------------------------------------------
 
@@ -660,6 +736,199 @@ $$fact
 making a recursive call, or returns directly the result of a recursive
 call).
 
+Decorating coroutines
+-------------------------------------------
+
+If both the decorated function and the caller are coroutine functions
+(i.e. they are defined with ``async def``) the decorated function is a
+coroutine function too, so that ``inspect.iscoroutinefunction``
+recognizes it, and it awaits the result of the caller:
+
+.. code-block:: python
+
+ @decorator
+ async def log_errors(coro, *args, **kw):
+     try:
+         return await coro(*args, **kw)
+     except Exception:
+         logging.exception('Error in %s', coro.__name__)
+         raise
+
+ @log_errors
+ async def fetch(url, timeout=10):
+     ...
+
+Since ``mode='lazy'``, ``mode='inline'`` and ``mode='light'`` cannot
+produce coroutine functions, they fall back to the default mode in that
+case. With a plain caller the decorated function is a plain function
+returning what the caller returns, as in the previous versions: it can
+be the coroutine returned by the original function, or its result, for
+instance for a caller like ``lambda f, *a, **k: asyncio.run(f(*a, **k))``.
+
+Decorating generators
+-------------------------------------------
+
+In the same way, on Python 3 the decorated function is a generator
+function if both the original function and the caller are generator
+functions, and an asynchronous generator function if both are
+asynchronous generator functions: the decorated function yields the
+items of the generator returned by the caller (with ``yield from`` or
+with ``async for``), so that the items are streamed as they are produced
+and nothing is kept in memory. For instance the following caller
+converts the rows to dictionaries:
+
+.. code-block:: python
+
+ @decorator
+ def as_dicts(rows, *args, **kw):
+     it = rows(*args, **kw)
+     names = next(it)
+     for row in it:
+         yield dict(zip(names, row))
+
+ @as_dicts
+ def read_csv(fname):
+     with open(fname) as f:
+         yield from csv.reader(f)
+
+Since the caller is a generator function, its body runs when the
+iteration begins, not when the decorated function is called, as it
+happens for the generator functions themselves. With a plain caller the
+decorated function is a plain function returning what the caller
+returns, for instance a list for ``lambda f, *a, **k: list(f(*a, **k))``.
+
+In order to observe the items, without replacing the generator, the
+caller can be an instance of a subclass of ``ItemCaller``, defining the
+hooks ``.start(func, *args, **kw)``, called when the iteration begins,
+``.item(state, item)``, called for each item and returning the item to
+be yielded, and ``.stop(state, exc)``, called when the iteration ends,
+where ``state`` is the object returned by ``.start`` and ``exc`` is the
+exception raised by the generator, or ``None``. The item callers work
+with both kinds of generators, even on Python 2:
+
+.. code-block:: python
+
+ >>> from decorator import ItemCaller
+ >>> class CountItems(ItemCaller):
+ ...     "Print the number of items produced"
+ ...     def start(self, func, *args, **kw):
+ ...         return [func.__name__, 0]
+ ...     def item(self, state, item):
+ ...         state[1] += 1
+ ...         return item
+ ...     def stop(self, state, exc):
+ ...         print('%s produced %d items' % tuple(state))
+
+ >>> countitems = decorator(CountItems())
+ >>> @countitems
+ ... def squares(n):
+ ...     for i in range(n):
+ ...         yield i * i
+
+ >>> for sq in squares(3):
+ ...     pass
+ squares produced 3 items
+
+Decorating methods
+-------------------------------------------
+
+Passing a class to a decorator with ``mode='method'`` decorates in one
+pass its methods, classmethods, staticmethods and properties (the special
+methods like ``__len__`` are left alone); the caller receives the
+instance (or the class, for classmethods) as first argument after the
+function:
+
+.. code-block:: python
+
+ >>> def log_calls(func, self, *args, **kw):
+ ...     print('calling %s.%s' % (type(self).__name__, func.__name__))
+ ...     return func(self, *args, **kw)
+
+ >>> @decorator(log_calls, mode='method')
+ ... class Session(object):
+ ...     def get(self, key):
+ ...         return key.upper()
+ ...     @classmethod
+ ...     def open(cls):
+ ...         return cls()
+
+ >>> session = Session.open()
+ calling type.open
+ >>> session.get('x')
+ calling Session.get
+ 'X'
+
+The decorated methods are plain functions, so that since CPython 3.7 the
+calls like ``session.get('x')`` do not create bound methods at all.
+Applied to a function, ``mode='method'`` is the same as the default mode.
+
+Measuring the calls
+-------------------------------------------
+
+The ``decorator`` module provides a ready-made decorator ``metered``
+recording the number of calls, the number of calls raising an exception
+and the histogram of the latencies of a function, without changing its
+signature:
+
+.. code-block:: python
+
+ >>> from decorator import metered, Metrics, prometheus_text
+ >>> def add(x, y=1):
+ ...     return x + y
+ >>> add = metered(add, 'add')  # by default the name is module.qualname
+ >>> add(1)
+ 2
+ >>> add.__metrics__.count, add.__metrics__.errors
+ (1, 0)
+
+The histogram has a fixed number of buckets: the bucket ``i`` counts the
+calls lasting less than ``2 ** i`` microseconds and the last one counts
+the calls lasting more than 16 seconds; recording a call only takes a
+lock and increments a counter, so it is safe in multithreaded programs.
+``.snapshot()`` returns a consistent copy of the metrics and
+``.merge(other)`` adds the counts of other metrics, for instance the
+ones collected in another process. The metrics of all the decorated
+functions are stored in ``Metrics.registry``, keyed by their names,
+and can be converted in the text format
+understood by Prometheus with ``prometheus_text()`` or written in a file
+with ``dump_metrics(path)``:
+
+.. code-block:: python
+
+ >>> print(prometheus_text([add.__metrics__]).splitlines()[-1])
+ decorator_call_errors_total{function="add"} 0
+ >>> del Metrics.registry['add']
+
+The ``trace`` decorator shown at the beginning of this document adds
+the cost of calling the caller to every call, even when the trace is not
+needed. ``traced`` records the calls in a ring buffer instead, keeping
+the most recent spans (name, thread id, start time, end time and status)
+of the functions for which tracing is enabled:
+
+.. code-block:: python
+
+ >>> from decorator import traced, tracer
+ >>> @traced
+ ... def double(x):
+ ...     return 2 * x
+ >>> double(1)
+ 2
+ >>> tracer.disable(double)
+ >>> double(2)
+ 4
+ >>> [span.status for span in tracer.spans()]
+ ['return']
+ >>> tracer.spans()[0].name.endswith('double')  # module.qualname
+ True
+ >>> tracer.clear()
+
+``tracer.enable(double)`` starts recording again and ``tracer.dump()``
+prints the spans; ``Tracer(size)`` creates a tracer with its own ring
+buffer. On Python 3.12 and later ``traced`` returns the function itself,
+observed with ``sys.monitoring`` (PEP 669), so calling it when tracing is
+disabled costs nothing; on older versions the function is decorated and
+the caller checks if tracing is enabled.
+
 Multiple dispatch
 -------------------------------------------
 
@@ -918,32 +1187,27 @@ Caveats and limitations
 -------------------------------------------
 
 One thing you should be aware of, is the performance penalty of decorators.
-The worse case is shown by the following example::
+The worse case is shown by the following benchmark::
 
- $ cat performance.sh
- python3 -m timeit -s "
- from decorator import decorator
+ $ cd src
+ $ python3 -m tests.benchmark call/positional/undecorated call/positional/exec
+ call/positional/undecorated                80.7 ns
+ call/positional/exec                      264.6 ns
+
+The benchmark compares a plain function ``f(a, b)`` doing nothing with
+the same function decorated with the ``do_nothing`` decorator::
 
- @decorator
  def do_nothing(func, *args, **kw):
      return func(*args, **kw)
 
- @do_nothing
- def f():
-     pass
- " "f()"
-
- python3 -m timeit -s "
- def f():
-     pass
- " "f()"
-
-On my laptop, using the ``do_nothing`` decorator instead of the
-plain function is five times slower::
-
- $ bash performance.sh
- 1000000 loops, best of 3: 1.39 usec per loop
- 1000000 loops, best of 3: 0.278 usec per loop
+On my laptop, the decorated function is more than three times slower.
+The module ``tests/benchmark.py`` contains other benchmarks (the cost
+of the decoration, of the calls for various signatures and modes, of
+``contextmanager`` and ``dispatch_on``, and the memory taken by the
+decorated functions); without arguments it runs all of them. With
+``-o results.json`` the results are saved in JSON format and with
+``-b results.json`` a later run is compared with them, failing if
+some benchmark is slower by more than 10%.
 
 It should be noted that a real life function would probably do
 something more useful than ``f`` here, and therefore in real life the
@@ -951,6 +1215,53 @@ performance penalty could be completely negligible.  As always, the
 only way to know if there is
 a penalty in your specific use case is to measure it.
 
+If you are decorating a large number of functions, the cost of the
+decoration itself may matter too. By default ``decorate`` generates the
+source code of a new function and executes it in a new namespace for
+each decorated function. With ``decorate(func, caller, mode='closure')``
+(or ``decorator(caller, mode='closure')``) a factory of closures is
+generated only once for each signature, so that decorating a function
+is just a function call and all the decorated functions with the same
+signature share the same code object and globals.
+Since tracebacks and profilers show such functions as ``_wrapper_``,
+there is also ``mode='shared'``, in which the closures built by the
+factory get their own code object, with the name of the decorated
+function and a new filename as in the default mode, while still
+sharing the globals: this is almost as fast as ``mode='closure'`` and
+saves about a sixth of the memory taken by each decorated function.
+With ``mode='lazy'`` nothing is generated until the decorated function
+is called for the first time: ``decorate`` returns a placeholder with the
+right name, docstring and ``__wrapped__`` attribute (so that
+``inspect.signature`` works) which is turned into the real decorated
+function at the first call. Notice that in this mode errors in the
+signature, such as an argument named ``_func_``, are raised at the first
+call and not at decoration time.
+
+When many decorators made with ``decorator(caller, mode='fuse')`` are
+stacked, the decorated function calls the outermost caller passing it a
+link to the next caller instead of the intermediate decorated function,
+so a call does not go through the intermediate functions. The link has
+the attributes of the intermediate function, but the arguments passed
+by a caller to the next one are not normalized by the signature as
+they would be by the intermediate function. The saving is significant
+on Python 3.10 and older, where frames are expensive, and negligible on
+more recent versions.
+
+Finally, if you do not need the exact behavior of the signature (for
+instance you do not care about getting a ``TypeError`` before entering
+the caller when the arguments are wrong) you can use
+``mode='light'``: nothing is generated and the decorated function is a
+predefined closure passing the arguments to the caller as they are. It
+has the right ``__name__``, ``__qualname__``, ``__doc__`` and
+``__wrapped__`` (so ``inspect.signature`` sees the original signature)
+and, being a function, it works as a method. Decorating is 5-10 times
+faster than in the default mode, since nothing is compiled, but calling
+is slower (1.3-2 times for the ``do_nothing`` decorator), since the
+arguments are collected in a tuple and a dictionary and then expanded
+again: it pays off when many functions are decorated and few of them
+are called often. Be aware that ``inspect.getfullargspec`` does not see
+the original signature.
+
 More importantly, you should be aware that decorators will make your
 tracebacks longer and more difficult to understand. Consider this
 example:
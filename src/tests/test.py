@@ -1,12 +1,24 @@
 from __future__ import absolute_import
+import os
+import copy
+import gc
+import ast
 import sys
+import shutil
+import linecache
+import tempfile
+import threading
+import weakref
 import doctest
 import unittest
 import decimal
 import inspect
 import functools
 import collections
-from decorator import dispatch_on, contextmanager, decorator
+from decorator import (dispatch_on, contextmanager, decorator, decorate,
+                       decorate_many, decorator_factory, getargspec,
+                       FunctionMaker, Metrics, ItemCaller, Memo,
+                       metered, dump_metrics, Tracer, memoize, normalizer)
 try:
     from . import documentation as doc
 except (SystemError, ValueError):
@@ -39,6 +51,15 @@ class DocumentationTestCase(unittest.TestCase):
             doc.singledispatch_example2()
 
 
+inline_calls = []
+
+
+def count_calls(f, *args, **kwargs):
+    "a caller simple enough to be inlined"
+    inline_calls.append(f.__name__)
+    return f(*args, **kwargs) + 1
+
+
 class ExtraTestCase(unittest.TestCase):
     def test_qualname(self):
         if sys.version >= '3.3':
@@ -80,6 +101,927 @@ class ExtraTestCase(unittest.TestCase):
         self.assertNotEqual(f1_orig.__code__.co_filename,
                             f1.__code__.co_filename)
 
+    def test_stable_filenames(self):
+        def d1(f, *args, **kwargs):
+            return f(*args, **kwargs)
+
+        def f1(x):
+            return x
+
+        FunctionMaker.stable_filenames = True
+        FunctionMaker.register_source = True
+        try:
+            g1 = decorate(f1, d1)
+            g2 = decorate(f1, d1)
+        finally:
+            FunctionMaker.stable_filenames = False
+            FunctionMaker.register_source = False
+        name = 'decorator-gen:%s.%s' % (__name__, getattr(
+            f1, '__qualname__', 'f1'))
+        self.assertEqual(g1.__code__.co_filename, name)
+        self.assertEqual(g2.__code__.co_filename, name + '#1')
+        self.assertEqual(linecache.getline(name, 2).strip(),
+                         'return _call_(_func_, x)')
+
+    def test_stats(self):
+        def d1(f, *args, **kwargs):
+            return f(*args, **kwargs)
+
+        def f1(x):
+            return x
+
+        FunctionMaker.reset_stats()
+        FunctionMaker.collect_stats = True
+        try:
+            decorate(f1, d1)
+            decorate(f1, d1, 'closure')
+        finally:
+            FunctionMaker.collect_stats = False
+        stats = FunctionMaker.stats()
+        self.assertEqual(list(stats), ['%s.%s' % (__name__, getattr(
+            d1, '__qualname__', 'd1'))])
+        phases = list(stats.values())[0]
+        self.assertEqual(phases['signature'][0], 2)
+        self.assertEqual(phases['update'][0], 2)
+        self.assertIn('exec', phases)
+        FunctionMaker.reset_stats()
+        self.assertEqual(FunctionMaker.stats(), {})
+
+    def test_code_cache(self):
+        @decorator
+        def d1(f, *args, **kwargs):
+            return f(*args, **kwargs)
+
+        @d1
+        def f1(x, y=1, *args, **kw):
+            return x, y
+
+        size = len(FunctionMaker._code_cache)
+
+        @d1
+        def f2(x, y=2, *args, **kw):
+            return y, x
+
+        if FunctionMaker.code_cache_size:  # the code object was reused
+            self.assertEqual(len(FunctionMaker._code_cache), size)
+        self.assertEqual(f1(0), (0, 1))
+        self.assertEqual(f2(0), (2, 0))
+        self.assertEqual(f2.__code__.co_name, 'f2')
+        self.assertNotEqual(f1.__code__.co_filename, f2.__code__.co_filename)
+        # the reused code objects see the builtins
+        for name in ('g1', 'g2'):
+            g = FunctionMaker.create('%s(x)' % name, 'return len(x)', {})
+            self.assertEqual(g('ab'), 2)
+
+    def test_closure_mode(self):
+        def d1(f, *args, **kwargs):
+            return f(*args, **kwargs)
+
+        def f1(x, y=1, *args, **kw):
+            "f1 docstring"
+            return x, y
+
+        def f2(x, y=2, *args, **kw):
+            return y, x
+
+        g1 = decorate(f1, d1, 'closure')
+        g2 = decorate(f2, d1, 'closure')
+        self.assertEqual(g1(0), (0, 1))
+        self.assertEqual(g2(0), (2, 0))
+        self.assertEqual(g1.__name__, 'f1')
+        self.assertEqual(g1.__doc__, 'f1 docstring')
+        self.assertEqual(g1.__wrapped__, f1)
+        self.assertEqual(getargspec(g2), getargspec(f2))
+        # same signature, same factory
+        self.assertIs(g1.__code__, g2.__code__)
+        with assertRaises(ValueError):
+            decorate(f1, d1, 'unknown')
+
+    def test_shared_mode(self):
+        def d1(f, *args, **kwargs):
+            return f(*args, **kwargs)
+
+        def f1(x, y=1, *args, **kw):
+            return x, y
+
+        def f2(x, y=2, *args, **kw):
+            return y, x
+
+        g1 = decorate(f1, d1, 'shared')
+        g2 = decorate(f2, d1, 'shared')
+        self.assertEqual(g1(0), (0, 1))
+        self.assertEqual(g2(0), (2, 0))
+        self.assertEqual(g1.__wrapped__, f1)
+        self.assertEqual(getargspec(g2), getargspec(f2))
+        self.assertIs(g1.__globals__, g2.__globals__)
+        self.assertNotIn('_func_', g1.__globals__)
+        if FunctionMaker.code_cache_size:  # code.replace is available
+            self.assertEqual(g2.__code__.co_name, 'f2')
+            self.assertNotEqual(g1.__code__.co_filename,
+                                g2.__code__.co_filename)
+
+    def test_signature_cache(self):
+        def f(x, y=1, *args, **kw):
+            return x, y
+
+        before = FunctionMaker.signature_cache_info()
+        g1 = decorate(f, lambda f, *args, **kw: f(*args, **kw))
+        g2 = decorate(f, lambda f, *args, **kw: f(*args, **kw))
+        after = FunctionMaker.signature_cache_info()
+        self.assertEqual(after.misses, before.misses + 1)
+        self.assertEqual(after.hits, before.hits + 1)
+        self.assertEqual(g2(0), (0, 1))
+        self.assertEqual(getargspec(g1), getargspec(f))
+
+    def test_lazy_mode(self):
+        def d1(f, *args, **kwargs):
+            return f(*args, **kwargs)
+
+        def f1(x, y=1, *args, **kw):
+            "f1 docstring"
+            return x, y
+
+        g1 = decorate(f1, d1, 'lazy')
+        self.assertEqual(g1.__name__, 'f1')
+        self.assertEqual(g1.__doc__, 'f1 docstring')
+        self.assertEqual(g1.__wrapped__, f1)
+        if hasattr(inspect, 'signature'):
+            self.assertEqual(str(inspect.signature(g1)),
+                             '(x, y=1, *args, **kw)')
+        code = g1.__code__
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(g1(0)))
+                   for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [(0, 1)] * 10)
+        self.assertNotEqual(g1.__code__, code)  # materialized
+        self.assertEqual(getargspec(g1), getargspec(f1))
+        self.assertEqual(g1(2, 3), (2, 3))
+
+        # decorating or dispatching on a placeholder sees the real signature
+        g2 = decorate(decorate(f1, d1, 'lazy'), d1)
+        self.assertEqual(getargspec(g2), getargspec(f1))
+        self.assertRaises(TypeError, g2)
+        self.assertEqual(g2(2, 3), (2, 3))
+        g3 = dispatch_on('y')(decorate(f1, d1, 'lazy'))
+        self.assertEqual(g3(2, 3), (2, 3))
+
+    def test_inline_mode(self):
+        def d2(f, *args, **kwargs):
+            for _ in range(2):
+                f(*args, **kwargs)
+
+        def f1(x, y=1, *args, **kw):
+            "f1 docstring"
+            return x + y
+
+        del inline_calls[:]
+        g1 = decorate(f1, count_calls, 'inline')
+        self.assertEqual(g1(1), 3)
+        self.assertEqual(inline_calls, ['f1'])
+        self.assertEqual(g1.__doc__, 'f1 docstring')
+        self.assertEqual(getargspec(g1), getargspec(f1))
+        g2 = decorate(f1, d2, 'inline')  # not inlinable
+        self.assertFalse(g2.__inlined__)
+        self.assertEqual(g2(1), None)
+        if hasattr(ast, 'unparse'):  # Python 3.9+
+            self.assertTrue(g1.__inlined__)
+            # a single frame: no call to count_calls
+            self.assertNotIn('_call_', g1.__code__.co_names)
+            # functions sharing the cached code keep their own filename
+            g3 = decorate(f1, count_calls, 'inline')
+            self.assertEqual(g3.__code__.co_code, g1.__code__.co_code)
+            self.assertNotEqual(g3.__code__.co_filename,
+                                g1.__code__.co_filename)
+
+    def test_fuse_mode(self):
+        def tag(n):
+            def caller(f, *args, **kw):
+                return [(n, f.__name__)] + f(*args, **kw)
+            return decorator(caller, mode='fuse')
+
+        @tag(1)
+        @tag(2)
+        @tag(3)
+        def f1(x):
+            "f1 docstring"
+            return [x]
+
+        self.assertEqual(f1(0), [(1, 'f1'), (2, 'f1'), (3, 'f1'), 0])
+        self.assertEqual(f1.__doc__, 'f1 docstring')
+        self.assertEqual(getargspec(f1), getargspec(f1.__wrapped__))
+        self.assertEqual(f1.__wrapped__.__wrapped__.__wrapped__(0), [0])
+        # the callers are chained
+        self.assertEqual(f1.__globals__['_func_'].__doc__, 'f1 docstring')
+        self.assertIsNot(f1.__globals__['_func_'], f1.__wrapped__)
+
+        # functions looking like decorated ones are not shortcut
+        def f2(x):
+            return [x]
+        g2 = FunctionMaker.create(f2, 'return _func_(x)',
+                                  dict(_call_=len, _func_=f2),
+                                  __wrapped__=f2)
+        self.assertEqual(tag(1)(g2)(0), [(1, 'f2'), 0])
+
+    def test_light_mode(self):
+        def d1(f, *args, **kwargs):
+            return f.__name__, f(*args, **kwargs)
+
+        class C(object):
+            def m(self, x=1):
+                "m docstring"
+                return x
+            m = decorate(m, d1, 'light')
+
+        c = C()
+        self.assertEqual(c.m(), ('m', 1))
+        self.assertEqual(C.m(c, 2), ('m', 2))
+        self.assertIs(c.m.__func__, vars(C)['m'])  # a native method
+        self.assertEqual(C.m.__name__, 'm')
+        self.assertEqual(C.m.__doc__, 'm docstring')
+        self.assertEqual(C.m.__module__, __name__)
+        if hasattr(inspect, 'signature'):
+            self.assertEqual(str(inspect.signature(C.m)), '(self, x=1)')
+
+    def test_decorate_many(self):
+        def d1(f, *args, **kwargs):
+            return f.__name__, f(*args, **kwargs)
+
+        def f1(x, y=1):
+            "f1 docstring"
+            return x + y
+
+        def f2(x, *args):
+            return args
+
+        g1, g2, g3 = decorate_many([f1, f2, f1], d1)
+        self.assertEqual(g1(1), ('f1', 2))
+        self.assertEqual(g2(1, 2), ('f2', (2,)))
+        self.assertEqual(g3.__doc__, 'f1 docstring')
+        self.assertEqual(g3.__wrapped__, f1)
+        self.assertEqual(getargspec(g2), getargspec(f2))
+        # the same filename, but different line numbers
+        self.assertEqual(g1.__code__.co_filename, g3.__code__.co_filename)
+        self.assertNotEqual(g1.__code__.co_firstlineno,
+                            g3.__code__.co_firstlineno)
+        # the functions are not confused with the arguments
+        self.assertRaises(NameError, decorate_many,
+                          [lambda _funcs_: _funcs_], d1)
+
+        def f3(_func0_, _func1_):
+            return _func0_ + _func1_
+        self.assertEqual(decorate_many([f1, f3], d1)[1](1, 2), ('f3', 3))
+
+    def test_create_many(self):
+        a, b = FunctionMaker.create_many(
+            [('a(x)', 'return x'),
+             ('b(x, y)', 'return x + y', dict(defaults=(1,), doc='b doc'))],
+            {})
+        self.assertEqual(a(1), 1)
+        self.assertEqual(b(1), 2)
+        self.assertEqual(b.__name__, 'b')
+        self.assertEqual(b.__doc__, 'b doc')
+        self.assertEqual(b.__source__, 'def b(x, y):\n    return x + y\n')
+
+    def test_module(self):
+        f1 = FunctionMaker.create('f1()', 'pass', {})
+        self.assertEqual(f1.__module__, __name__)
+        f2 = FunctionMaker.create('f2()', 'pass', {}, module='mod')
+        self.assertEqual(f2.__module__, 'mod')
+
+    def test_maker_layout(self):
+        def f(x, y):
+            return x, y
+
+        maker = FunctionMaker(f)
+        self.assertFalse(hasattr(maker, '__dict__'))
+        self.assertFalse(hasattr(maker, 'dict'))  # empty, not copied
+        self.assertEqual(maker['arg1'], 'y')
+        with assertRaises(KeyError):
+            maker['arg2']
+        g = maker.make('def %(name)s(%(signature)s):\n'
+                       '    return %(arg1)s, %(arg0)s')
+        self.assertEqual(g(1, 2), (2, 1))
+        f.attr = 1
+        self.assertEqual(FunctionMaker(f).dict, {'attr': 1})
+
+    def test_cache_dir(self):
+        if not FunctionMaker.code_cache_size:  # old Python
+            return
+        cache_dir = tempfile.mkdtemp()
+        FunctionMaker.cache_dir = cache_dir
+        try:
+            f1 = FunctionMaker.create('f1(a, b)', 'return a + b, %r' %
+                                      cache_dir, {})
+            FunctionMaker._stores[cache_dir].save()
+            self.assertEqual(len(os.listdir(cache_dir)), 1)
+            # simulate a new process
+            FunctionMaker._stores.clear()
+            FunctionMaker._code_cache.clear()
+            f2 = FunctionMaker.create('f2(a, b)', 'return a + b, %r' %
+                                      cache_dir, {})
+            self.assertEqual(FunctionMaker._stores[cache_dir].new, {})
+            self.assertEqual(f2(1, 2), (3, cache_dir))
+            self.assertEqual(f2.__name__, 'f2')
+            self.assertNotEqual(f1.__code__.co_filename,
+                                f2.__code__.co_filename)
+            # the oldest entries are dropped beyond max_entries
+            store = FunctionMaker._stores[cache_dir]
+            CodeStore, max_entries = type(store), store.max_entries
+            CodeStore.max_entries = 2
+            try:
+                for i in range(3):
+                    FunctionMaker.create('f%d(a, b%d)' % (i, i),
+                                         'return a', {})
+                store.save()
+                FunctionMaker._stores.clear()
+                FunctionMaker._code_cache.clear()
+                FunctionMaker.create('g(a, b2)', 'return a', {})  # merge
+                store = FunctionMaker._stores[cache_dir]
+                self.assertEqual(len(store.entries), 2)
+                self.assertEqual(store.new, {})  # the newest one is kept
+                self.assertEqual(len(os.listdir(cache_dir)), 1)
+            finally:
+                CodeStore.max_entries = max_entries
+        finally:
+            FunctionMaker.cache_dir = None
+            FunctionMaker._stores.clear()
+            shutil.rmtree(cache_dir)
+
+    def test_threads(self):
+        # decorate and dispatch from many threads at the same time
+        @dispatch_on('obj')
+        def show(obj):
+            return 'object'
+
+        classes = [type('C%d' % i, (object,), {}) for i in range(20)]
+        errors = []
+
+        def work(i):
+            try:
+                for j, cls in enumerate(classes):
+                    mode = ['exec', 'closure', 'lazy', 'light'][j % 4]
+
+                    def f(x, y=j):
+                        return x + y
+                    g = decorate(f, count_calls, mode)
+                    assert g(i) == i + j + 1, (mode, g(i))
+                    if i == j:
+                        show.register(cls)(lambda obj, n=j: n)
+                    assert show(cls()) in ('object', j)
+                    assert show(1) == 'object'
+                    show.vancestors(cls)
+            except Exception as exc:
+                errors.append(exc)
+
+        threads = [threading.Thread(target=work, args=(i,))
+                   for i in range(len(classes))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        del inline_calls[:]
+        self.assertEqual(errors, [])
+        self.assertEqual(len(show.typemap), len(classes))
+        self.assertEqual([show(cls()) for cls in classes],
+                         list(range(len(classes))))
+
+    def test_metered(self):
+        def f(x, y=1):
+            if x < 0:
+                raise ValueError(x)
+            return x + y
+
+        g = metered(f, 'test.f')
+        self.assertEqual(getargspec(g), getargspec(f))
+        self.assertEqual(g(1), 2)
+        with assertRaises(ValueError):
+            g(-1)
+        metrics = g.__metrics__
+        self.assertIs(Metrics.registry['test.f'], metrics)
+        self.assertEqual((metrics.count, metrics.errors), (2, 1))
+        histogram = Metrics('histogram')
+        histogram.record(3E-6)  # the bucket up to 4 usec is the third
+        histogram.record(1E6)  # beyond the last bound
+        self.assertEqual(histogram.snapshot().buckets[2], 1)
+        self.assertEqual(histogram.buckets[-1], 1)
+        total = Metrics('total').merge(metrics).merge(histogram)
+        self.assertEqual((total.count, total.errors), (4, 1))
+        with assertRaises(ValueError):
+            total.merge(Metrics('other', nbuckets=10))
+        tmp = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp, 'metrics.prom')
+            dump_metrics(path, [metrics])
+            with open(path) as f:
+                lines = f.read().splitlines()
+        finally:
+            del Metrics.registry['test.f']
+            shutil.rmtree(tmp)
+        self.assertIn('decorator_call_seconds_bucket'
+                      '{function="test.f",le="+Inf"} 2', lines)
+        self.assertIn('decorator_call_seconds_count{function="test.f"} 2',
+                      lines)
+        self.assertIn('decorator_call_errors_total{function="test.f"} 1',
+                      lines)
+
+    def test_metered_generators(self):
+        def numbers(n):
+            for i in range(n):
+                yield i
+            raise ValueError(n)
+        g = metered(numbers, 'test.numbers')
+        del Metrics.registry['test.numbers']
+        items = g(2)
+        self.assertEqual(g.__metrics__.count, 0)  # not started yet
+        self.assertEqual([next(items), next(items)], [0, 1])
+        self.assertRaises(ValueError, next, items)
+        self.assertEqual((g.__metrics__.count, g.__metrics__.errors), (1, 1))
+        # closing the generator early is not an error
+        items = g(3)
+        self.assertEqual([next(items), next(items)], [0, 1])
+        items.close()
+        self.assertEqual((g.__metrics__.count, g.__metrics__.errors), (2, 1))
+
+        if not hasattr(inspect, 'iscoroutinefunction'):  # Python < 3.5
+            return
+        import asyncio
+        dic = dict(asyncio=asyncio)
+        exec('''
+async def fail(delay):
+    await asyncio.sleep(delay)
+    raise ValueError(delay)
+''', dic)
+        f = metered(dic['fail'], 'test.fail')
+        del Metrics.registry['test.fail']
+        self.assertTrue(inspect.iscoroutinefunction(f))
+        loop = asyncio.new_event_loop()
+        try:
+            self.assertRaises(ValueError, loop.run_until_complete, f(.05))
+        finally:
+            loop.close()
+        metrics = f.__metrics__
+        self.assertEqual((metrics.count, metrics.errors), (1, 1))
+        self.assertGreaterEqual(metrics.sum, .05)
+        # a cancelled coroutine is not an error
+        loop = asyncio.new_event_loop()
+        try:
+            task = loop.create_task(f(1))
+            loop.call_soon(task.cancel)
+            self.assertRaises(asyncio.CancelledError,
+                              loop.run_until_complete, task)
+        finally:
+            loop.close()
+        self.assertEqual((metrics.count, metrics.errors), (2, 1))
+
+    def test_tracer(self):
+        tracer = Tracer(size=3)
+
+        def f(x):
+            if x < 0:
+                raise ValueError(x)
+            return x
+
+        g = tracer.trace(f, enabled=False)
+        if hasattr(sys, 'monitoring'):  # Python 3.12+, nothing is wrapped
+            self.assertIs(g, f)
+        else:
+            self.assertEqual(getargspec(g), getargspec(f))
+        g(1)
+        self.assertEqual(tracer.spans(), [])
+        tracer.enable(g)
+        try:
+            for i in range(3):
+                g(i)
+            with assertRaises(ValueError):
+                g(-1)
+        finally:
+            tracer.disable(g)
+        g(1)
+        spans = tracer.spans()  # only the last 3 spans are kept
+        self.assertEqual([span.status for span in spans],
+                         ['return', 'return', 'raise'])
+        self.assertTrue(spans[0].name.endswith('f'))
+        self.assertTrue(all(span.start <= span.end for span in spans))
+        tracer.clear()
+        self.assertEqual(tracer.spans(), [])
+
+        # closures sharing their code are traced separately
+        def make(n):
+            def h():
+                return n
+            return h
+
+        h1 = tracer.trace(make(1))
+        h2 = tracer.trace(make(2), enabled=False)
+        try:
+            self.assertEqual((h1(), h2()), (1, 2))
+        finally:
+            tracer.disable(h1)
+        self.assertEqual(len(tracer.spans()), 1)
+        tracer.clear()
+
+        # a function is enabled in a single tracer at the same time
+        code, other = f.__code__, Tracer()
+        g = tracer.trace(f)
+        self.assertRaises(ValueError, other.enable, g)
+        other.disable(g)  # does nothing
+        other.trace(f, enabled=False)(1)
+        try:
+            g(1)
+        finally:
+            tracer.disable(g)
+        self.assertEqual((len(tracer.spans()), other.spans()), (2, []))
+        self.assertIs(f.__code__, code)  # restored
+        tracer.clear()
+
+        if hasattr(sys, 'monitoring'):  # generators are observed too
+            def gen():
+                while True:
+                    try:
+                        yield
+                    except ValueError:
+                        pass
+
+            it = tracer.trace(gen)()
+            try:
+                next(it)
+                it.throw(ValueError)  # resumed by PY_THROW
+            finally:
+                tracer.disable(gen)
+            self.assertEqual([span.status for span in tracer.spans()],
+                             ['yield', 'yield'])
+
+    def test_decorator_cache(self):
+        def d1(f, *args, **kwargs):
+            return f(*args, **kwargs)
+
+        dec = decorator(d1)
+        self.assertIs(decorator(d1), dec)
+        self.assertIsNot(decorator(d1, mode='closure'), dec)
+        ref = weakref.ref(d1)
+        del d1, dec
+        gc.collect()
+        self.assertIsNone(ref())  # the cache does not keep d1 alive
+
+    def test_decorator_factory(self):
+        def busy(msg, f, *args, **kw):
+            "return msg and the result"
+            return msg, f(*args, **kw)
+
+        factory = decorator_factory(busy)
+        self.assertEqual(factory.__name__, 'busy')
+        self.assertEqual(getargspec(factory).args, ['msg'])
+
+        @factory('busy')
+        def f(x, y=1):
+            return x + y
+        self.assertEqual(f(1), ('busy', 2))
+        self.assertEqual(getargspec(f), (['x', 'y'], None, None, (1,)))
+        with assertRaises(TypeError):
+            decorator_factory(FunctionMaker)
+
+    def test_coroutine(self):
+        if not hasattr(inspect, 'iscoroutinefunction'):  # Python < 3.5
+            return
+        import asyncio
+        dic = {}
+        exec('''
+async def tag(f, *args, **kw):
+    return 'tag', await f(*args, **kw)
+
+async def f(x, y=1):
+    return x + y
+''', dic)
+        tag, f = dic['tag'], dic['f']
+        loop = asyncio.new_event_loop()
+        try:
+            for mode in ('exec', 'closure', 'shared', 'lazy', 'inline',
+                         'light', 'fuse'):
+                g = decorate(f, tag, mode)
+                self.assertTrue(inspect.iscoroutinefunction(g), mode)
+                self.assertEqual(getargspec(g), getargspec(f))
+                self.assertEqual(loop.run_until_complete(g(1)), ('tag', 2))
+            # a plain caller gives a plain function, returning the coroutine
+            g = decorator(lambda f, *args, **kw: f(*args, **kw))(f)
+            self.assertFalse(inspect.iscoroutinefunction(g))
+            self.assertEqual(loop.run_until_complete(g(1)), 2)
+            # or the result of running it
+            run = decorator(lambda f, *args, **kw: loop.run_until_complete(
+                f(*args, **kw)))
+            self.assertEqual(run(f)(1), 2)
+        finally:
+            loop.close()
+
+    def test_generator(self):
+        class CountItems(ItemCaller):
+            def start(self, func, *args, **kw):
+                return [func.__name__, 0]
+
+            def item(self, state, item):
+                state[1] += 1
+                return item
+
+            def stop(self, state, exc):
+                log.append((state[0], state[1], type(exc).__name__))
+
+        def numbers(n, fail=False):
+            i = 0
+            while i < n:
+                yield i
+                i += 1
+            if fail:
+                raise ValueError(n)
+
+        log = []
+        for mode in ('exec', 'closure', 'shared', 'lazy', 'light', 'fuse'):
+            g = decorate(numbers, CountItems(), mode)
+            self.assertTrue(inspect.isgeneratorfunction(g), mode)
+            self.assertEqual(getargspec(g), getargspec(numbers))
+            items = g(3)
+            self.assertEqual(log, [])  # nothing happens before iterating
+            self.assertEqual(next(items), 0)
+            self.assertEqual(list(items), [1, 2])
+            self.assertEqual(log.pop(), ('numbers', 3, 'NoneType'))
+            self.assertRaises(ValueError, list, g(2, fail=True))
+            self.assertEqual(log.pop(), ('numbers', 2, 'ValueError'))
+            items = g(10 ** 9)  # the items are observed lazily
+            self.assertEqual(next(items), 0)
+            items.close()
+            self.assertEqual(log.pop(), ('numbers', 1, 'GeneratorExit'))
+        self.assertRaises(TypeError, decorate, lambda: 1, CountItems())
+
+        if sys.version_info < (3, 3):  # no yield from
+            return
+        dic = {}
+        exec('''
+def double(f, *args, **kw):
+    for item in f(*args, **kw):
+        yield 2 * item
+''', dic)
+        for mode in ('exec', 'closure', 'shared', 'lazy', 'fuse'):
+            g = decorate(numbers, dic['double'], mode)
+            self.assertTrue(inspect.isgeneratorfunction(g), mode)
+            self.assertEqual(list(g(3)), [0, 2, 4])
+
+        # a plain caller gives a plain function, called immediately
+        g = decorate(numbers, lambda f, *args, **kw: list(f(*args, **kw)))
+        self.assertFalse(inspect.isgeneratorfunction(g))
+        self.assertEqual(g(3), [0, 1, 2])
+
+    def test_async_generator(self):
+        if not hasattr(inspect, 'isasyncgenfunction'):  # Python < 3.6
+            return
+        import asyncio
+        dic = {}
+        exec('''
+async def double(f, *args, **kw):
+    async for item in f(*args, **kw):
+        yield 2 * item
+
+async def numbers(n):
+    for i in range(n):
+        yield i
+
+async def collect(items):
+    return [item async for item in items]
+''', dic)
+        numbers, collect = dic['numbers'], dic['collect']
+
+        class Total(ItemCaller):
+            def start(self, func, *args, **kw):
+                return [0]
+
+            def item(self, state, item):
+                state[0] += item
+                return item
+
+            def stop(self, state, exc):
+                totals.append(state[0])
+        totals = []
+        loop = asyncio.new_event_loop()
+        try:
+            for mode in ('exec', 'closure', 'shared', 'lazy', 'fuse'):
+                g = decorate(numbers, dic['double'], mode)
+                self.assertTrue(inspect.isasyncgenfunction(g), mode)
+                self.assertEqual(loop.run_until_complete(collect(g(3))),
+                                 [0, 2, 4])
+                g = decorate(numbers, Total(), mode)
+                self.assertTrue(inspect.isasyncgenfunction(g), mode)
+                self.assertEqual(loop.run_until_complete(collect(g(4))),
+                                 [0, 1, 2, 3])
+                self.assertEqual(totals.pop(), 6)
+        finally:
+            loop.close()
+
+    def test_method_mode(self):
+        calls = []
+
+        def log(func, *args, **kw):
+            calls.append((func.__name__, args))
+            return func(*args, **kw)
+
+        @decorator(log, mode='method')
+        class Model(object):
+            def get(self, key, default=None):
+                return self.__dict__.get(key, default)
+
+            @classmethod
+            def create(cls):
+                return cls()
+
+            @staticmethod
+            def check(value):
+                return value > 0
+
+            @property
+            def size(self):
+                return 1
+
+            def __len__(self):  # special methods are not decorated
+                return 0
+
+        class SubModel(Model):
+            def get(self, key, default=None):
+                return Model.get(self, key, default) or 'missing'
+
+        obj = Model.create()
+        self.assertEqual(calls, [('create', (Model,))])
+        self.assertEqual(getargspec(Model.get).args, ['self', 'key',
+                                                      'default'])
+        self.assertEqual(obj.get('x', 1), 1)
+        self.assertEqual(vars(obj), {})  # the instances are left alone
+        obj2 = copy.copy(obj)
+        self.assertEqual(obj2.get('x', 2), 2)
+        self.assertTrue(Model.check(1))
+        self.assertEqual(obj.size, 1)
+        self.assertEqual(len(obj), 0)
+        self.assertEqual(calls[1:], [('get', (obj, 'x', 1)),
+                                     ('get', (obj2, 'x', 2)),
+                                     ('check', (1,)), ('size', (obj,))])
+
+        # the subclasses are not decorated, but they call the base methods
+        sub = SubModel()
+        self.assertEqual(sub.get('x'), 'missing')
+        self.assertEqual(calls[-1], ('get', (sub, 'x', None)))
+
+        # on a function the mode is the same as the default one
+        def getx(self):
+            return self.x
+        self.assertTrue(inspect.isfunction(decorate(getx, log, 'method')))
+
+    def test_memoize(self):
+        calls = []
+
+        @memoize(maxsize=2)
+        def add(x, y=1, *args, **kw):
+            "add docstring"
+            calls.append(x)
+            return x + y + sum(args) + sum(kw.values())
+
+        self.assertEqual(getargspec(add), getargspec(add.__wrapped__))
+        self.assertEqual(add.__doc__, 'add docstring')
+        # the keys are normalized: same values, same entry
+        self.assertEqual([add(1), add(x=1), add(1, 1), add(y=1, x=1)],
+                         [2, 2, 2, 2])
+        self.assertEqual(calls, [1])
+        self.assertEqual(add(1, 1, 2, z=3), 7)
+        self.assertEqual(add(1, 1, 2, z=3), 7)
+        self.assertEqual(add.__memo__.info(), (4, 2, 0, 2, 2))
+        add(2)  # evicts the least recently used entry, i.e. add(1)
+        add(1)
+        self.assertEqual(calls, [1, 1, 2, 1])
+        self.assertEqual(add.__memo__.info(), (4, 4, 2, 2, 2))
+        self.assertRaises(TypeError, add, [])  # unhashable argument
+        add.__memo__.clear()
+        self.assertEqual(add.__memo__.info(), (0, 0, 0, 0, 2))
+
+        # the entries expire
+        memo = Memo(ttl=.01)
+        memo.put('x', 1)
+        self.assertEqual(memo.get('x'), 1)
+        memo.data['x'] = 1, 0  # expired long ago
+        self.assertIsNone(memo.get('x'))
+        self.assertEqual(memo.info(), (1, 1, 1, 0, 128))
+
+        # the names used by the memoize template are reserved only there
+        def key(_key_):
+            return _key_
+        self.assertEqual(decorate(key, count_calls)(1), 2)
+        self.assertRaises(NameError, memoize, key)
+
+        # the results of generator functions cannot be reused
+        def numbers():
+            yield 1
+        self.assertRaises(TypeError, memoize, numbers)
+
+        # concurrent calls
+        @memoize(maxsize=50)
+        def square(x):
+            return x * x
+
+        def work():
+            for i in range(1000):
+                self.assertEqual(square(i % 100), (i % 100) ** 2)
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        info = square.__memo__.info()
+        self.assertEqual(info.hits + info.misses, 4000)
+        self.assertEqual(info.currsize, 50)
+
+    def test_memoize_async(self):
+        if not hasattr(inspect, 'iscoroutinefunction'):  # Python < 3.5
+            return
+        import asyncio
+        calls = []
+        dic = dict(asyncio=asyncio, calls=calls)
+        exec('''
+async def fetch(key, delay=.01):
+    calls.append(key)
+    await asyncio.sleep(delay)
+    if key < 0:
+        raise ValueError(key)
+    return key * 2
+
+async def fetch_many(fetch, n):
+    return await asyncio.gather(*[fetch(1) for _ in range(n)])
+
+async def cancel_one(fetch):
+    t1 = asyncio.ensure_future(fetch(2))
+    t2 = asyncio.ensure_future(fetch(2))
+    await asyncio.sleep(0)
+    t1.cancel()
+    return await t2, t1.cancelled()
+
+async def fail(fetch):
+    for _ in range(2):
+        try:
+            await fetch(-1)
+        except ValueError:
+            pass
+''', dic)
+        loop = asyncio.new_event_loop()
+        try:
+            fetch = memoize(dic['fetch'])
+            self.assertTrue(inspect.iscoroutinefunction(fetch))
+            self.assertEqual(getargspec(fetch), getargspec(dic['fetch']))
+            # the concurrent calls share a single call
+            self.assertEqual(
+                loop.run_until_complete(dic['fetch_many'](fetch, 50)),
+                [2] * 50)
+            self.assertEqual(calls, [1])
+            self.assertEqual(loop.run_until_complete(fetch(key=1)), 2)
+            self.assertEqual(calls, [1])
+            # cancelling a caller does not cancel the shared call
+            self.assertEqual(loop.run_until_complete(dic['cancel_one'](fetch)),
+                             (4, True))
+            self.assertEqual(calls, [1, 2])
+            # the exceptions are not cached by default
+            loop.run_until_complete(dic['fail'](fetch))
+            self.assertEqual(calls, [1, 2, -1, -1])
+            del calls[:]
+            fetch = memoize(exceptions=True)(dic['fetch'])
+            loop.run_until_complete(dic['fail'](fetch))
+            self.assertEqual(calls, [-1])
+            # a memoized coroutine function can be decorated in fuse mode
+            del calls[:]
+            fetch = decorate(memoize(dic['fetch']),
+                             lambda f, *args, **kw: f(*args, **kw), 'fuse')
+            self.assertEqual(loop.run_until_complete(fetch(3)), 6)
+            self.assertEqual(calls, [3])
+            # the arguments can have any name, even keyword-only ones
+            exec('''
+async def get(*, key, func=None):
+    return key
+''', dic)
+            self.assertEqual(loop.run_until_complete(
+                memoize(dic['get'])(key=1, func=2)), 1)
+        finally:
+            loop.close()
+
+    def test_normalizer(self):
+        def f(x, y=2, *args, **kw):
+            pass
+        norm = normalizer(f)
+        self.assertIs(normalizer(f), norm)  # generated once
+        self.assertEqual(getargspec(norm), getargspec(f))
+        self.assertEqual(norm(1), (1, 2, (), {}))
+        self.assertEqual(norm(y=3, x=1), (1, 3, (), {}))
+        self.assertEqual(norm(1, 3, 4, z=5), (1, 3, (4,), {'z': 5}))
+        self.assertRaises(TypeError, norm)
+        self.assertRaises(TypeError, norm, 1, x=1)
+        self.assertEqual(normalizer(lambda: None)(), ())
+        if sys.version_info >= (3,):
+            dic = {}
+            exec('def g(a, *, b=1, c): pass', dic)
+            self.assertEqual(normalizer(dic['g'])(0, c=2), (0, 1, 2))
+
     def test_no_first_arg(self):
         @decorator
         def example(*args, **kw):